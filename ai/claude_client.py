@@ -1,10 +1,16 @@
 """Клиент для работы с Claude API."""
-from anthropic import Anthropic
+from functools import lru_cache
+import httpx
+from anthropic import Anthropic, AsyncAnthropic, DefaultAsyncHttpxClient
 from config.settings import settings
 from typing import Optional, Dict, Any
 import json
 from loguru import logger
 
+# Пул соединений асинхронного клиента (общий для всех параллельных запросов)
+CLAUDE_MAX_CONNECTIONS = 32
+CLAUDE_MAX_KEEPALIVE_CONNECTIONS = 16
+
 
 class ClaudeClient:
     """Клиент для взаимодействия с Claude API."""
@@ -13,6 +19,16 @@ class ClaudeClient:
         """Инициализировать клиент Claude."""
         try:
             self.client = Anthropic(api_key=settings.claude_api_key)
+            # Асинхронный клиент — для параллельных запросов без блокировки event loop
+            self.aclient = AsyncAnthropic(
+                api_key=settings.claude_api_key,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=CLAUDE_MAX_CONNECTIONS,
+                        max_keepalive_connections=CLAUDE_MAX_KEEPALIVE_CONNECTIONS
+                    )
+                )
+            )
             # Используем актуальное имя модели Claude 4 Sonnet согласно документации
             self.model = "claude-sonnet-4-20250514"  # Claude 4 Sonnet
         except Exception as e:
@@ -45,22 +61,45 @@ class ClaudeClient:
                 
                 message = self.client.messages.create(**request_params)
                 
-                if message.content and len(message.content) > 0:
-                    first_content = message.content[0]
-                    if hasattr(first_content, 'text'):
-                        logger.info(f"Успешно использована модель: {model_name}")
-                        self.model = model_name  # Сохраняем рабочую модель
-                        return first_content.text
-                    elif isinstance(first_content, dict) and 'text' in first_content:
-                        logger.info(f"Успешно использована модель: {model_name}")
-                        self.model = model_name
-                        return first_content['text']
+                if message.content:
+                    logger.info(f"Успешно использована модель: {model_name}")
+                    self.model = model_name  # Сохраняем рабочую модель
+                    return self.extract_text(message)
             except Exception as e:
                 logger.warning(f"Модель {model_name} не работает: {e}")
                 continue
         
         raise ValueError("Ни одна из моделей Claude не доступна")
     
+    @staticmethod
+    def extract_text(message) -> str:
+        """Извлечь текст из ответа Claude."""
+        # response.content - это массив блоков; SDK возвращает текст в TextBlock.text
+        if not message.content:
+            raise ValueError("Пустой ответ от Claude API")
+        try:
+            return message.content[0].text
+        except AttributeError:
+            return str(message.content[0])
+    
+    def _completion_params(
+        self,
+        prompt: str,
+        system_prompt: Optional[str],
+        max_tokens: int
+    ) -> Dict[str, Any]:
+        """Параметры запроса messages.create для текстового промпта."""
+        # content может быть строкой или массивом объектов с type и text
+        request_params = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        # Если есть system prompt, добавляем его как строку (согласно документации)
+        if system_prompt:
+            request_params["system"] = system_prompt
+        return request_params
+    
     def get_completion(
         self,
         prompt: str,
@@ -69,42 +108,27 @@ class ClaudeClient:
     ) -> str:
         """Получить ответ от Claude."""
         try:
-            # Формируем messages согласно документации Claude API
-            # content может быть строкой или массивом объектов с type и text
-            messages = [
-                {
-                    "role": "user",
-                    "content": prompt  # Простая строка работает в новом API
-                }
-            ]
-            
-            # Формируем параметры запроса
-            request_params = {
-                "model": self.model,
-                "max_tokens": max_tokens,
-                "messages": messages
-            }
-            
-            # Если есть system prompt, добавляем его как строку (согласно документации)
-            if system_prompt:
-                request_params["system"] = system_prompt
-            
-            message = self.client.messages.create(**request_params)
-            
-            # Извлекаем текст из ответа
-            # response.content - это массив объектов с type и text
-            if message.content and len(message.content) > 0:
-                # Проверяем тип первого элемента
-                first_content = message.content[0]
-                if hasattr(first_content, 'text'):
-                    return first_content.text
-                elif isinstance(first_content, dict) and 'text' in first_content:
-                    return first_content['text']
-                else:
-                    # Если это объект TextBlock
-                    return str(first_content)
-            else:
-                raise ValueError("Пустой ответ от Claude API")
+            message = self.client.messages.create(
+                **self._completion_params(prompt, system_prompt, max_tokens)
+            )
+            return self.extract_text(message)
+        except Exception as e:
+            logger.error(f"Ошибка при запросе к Claude API: {e}")
+            logger.error(f"Тип ошибки: {type(e)}")
+            raise
+    
+    async def aget_completion(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024
+    ) -> str:
+        """Получить ответ от Claude, не блокируя event loop."""
+        try:
+            message = await self.aclient.messages.create(
+                **self._completion_params(prompt, system_prompt, max_tokens)
+            )
+            return self.extract_text(message)
         except Exception as e:
             logger.error(f"Ошибка при запросе к Claude API: {e}")
             logger.error(f"Тип ошибки: {type(e)}")
@@ -230,3 +254,12 @@ class ClaudeClient:
             logger.error(f"Ошибка при предложении категории: {e}")
             return None
 
+
+@lru_cache(maxsize=None)
+def get_claude_client() -> ClaudeClient:
+    """Общий экземпляр ClaudeClient.
+    
+    HTTP-клиенты и их пулы соединений создаются один раз и переиспользуются
+    всеми запросами вместо нового TLS-соединения на каждый вызов.
+    """
+    return ClaudeClient()
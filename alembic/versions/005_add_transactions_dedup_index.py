@@ -0,0 +1,33 @@
+"""Add dedup index on transactions
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-15 08:35:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Создать индекс для поиска дубликатов при импорте (без блокировки записи)."""
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tx_dedup',
+            'transactions',
+            ['user_id', 'date', 'amount'],
+            unique=False,
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    """Удалить индекс для поиска дубликатов."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tx_dedup', table_name='transactions', postgresql_concurrently=True)
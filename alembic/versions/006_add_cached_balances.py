@@ -0,0 +1,42 @@
+"""Add cached_balances table
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-15 08:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '006'
+down_revision = '005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Создать таблицу cached_balances и заполнить её по существующим транзакциям."""
+    op.create_table(
+        'cached_balances',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('income_total', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('expense_total', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+    op.execute("""
+        INSERT INTO cached_balances (user_id, income_total, expense_total)
+        SELECT
+            user_id,
+            COALESCE(SUM(CASE WHEN type = 'INCOME' THEN amount END), 0),
+            COALESCE(SUM(CASE WHEN type = 'EXPENSE' THEN amount END), 0)
+        FROM transactions
+        GROUP BY user_id
+    """)
+
+
+def downgrade():
+    """Удалить таблицу cached_balances."""
+    op.drop_table('cached_balances')
@@ -0,0 +1,33 @@
+"""Add (user_id, date desc, created_at desc) index on transactions
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-15 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '007'
+down_revision = '006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Создать индекс для ленты транзакций пользователя (без блокировки записи)."""
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tx_user_date_created',
+            'transactions',
+            ['user_id', sa.text('date DESC'), sa.text('created_at DESC')],
+            unique=False,
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    """Удалить индекс ленты транзакций."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tx_user_date_created', table_name='transactions', postgresql_concurrently=True)
@@ -0,0 +1,45 @@
+"""Store money amounts as NUMERIC instead of float
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-15 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '008'
+down_revision = '007'
+branch_labels = None
+depends_on = None
+
+# (таблица, столбец, точность)
+MONEY_COLUMNS = [
+    ('transactions', 'amount', 14),
+    ('budgets', 'limit_amount', 14),
+    ('cached_balances', 'income_total', 16),
+    ('cached_balances', 'expense_total', 16),
+]
+
+
+def upgrade():
+    """Перевести денежные столбцы на NUMERIC."""
+    for table, column, precision in MONEY_COLUMNS:
+        op.alter_column(
+            table, column,
+            type_=sa.Numeric(precision, 2),
+            existing_type=sa.Float(),
+            postgresql_using=f'{column}::numeric({precision}, 2)'
+        )
+
+
+def downgrade():
+    """Вернуть денежные столбцы к float."""
+    for table, column, precision in MONEY_COLUMNS:
+        op.alter_column(
+            table, column,
+            type_=sa.Float(),
+            existing_type=sa.Numeric(precision, 2),
+            postgresql_using=f'{column}::double precision'
+        )
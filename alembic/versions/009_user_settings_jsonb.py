@@ -0,0 +1,36 @@
+"""Store user settings as JSONB
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-15 09:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '009'
+down_revision = '008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Перевести users.settings на JSONB (слияние настроек на стороне БД)."""
+    op.alter_column(
+        'users', 'settings',
+        type_=postgresql.JSONB(astext_type=sa.Text()),
+        existing_type=postgresql.JSON(astext_type=sa.Text()),
+        postgresql_using='settings::jsonb'
+    )
+
+
+def downgrade():
+    """Вернуть users.settings к JSON."""
+    op.alter_column(
+        'users', 'settings',
+        type_=postgresql.JSON(astext_type=sa.Text()),
+        existing_type=postgresql.JSONB(astext_type=sa.Text()),
+        postgresql_using='settings::json'
+    )
@@ -0,0 +1,44 @@
+"""Add category_month_stats table
+
+Revision ID: 010
+Revises: 009
+Create Date: 2026-10-15 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '010'
+down_revision = '009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Создать таблицу помесячных итогов по категориям и заполнить её по существующим транзакциям."""
+    op.create_table(
+        'category_month_stats',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('category_id', sa.Integer(), nullable=False),
+        sa.Column('type', postgresql.ENUM('INCOME', 'EXPENSE', name='transactiontype', create_type=False), nullable=False),
+        sa.Column('month', sa.Date(), nullable=False),
+        sa.Column('total', sa.Numeric(16, 2), nullable=False, server_default='0'),
+        sa.Column('count', sa.Integer(), nullable=False, server_default='0'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['category_id'], ['categories.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'category_id', 'type', 'month')
+    )
+    op.execute("""
+        INSERT INTO category_month_stats (user_id, category_id, type, month, total, count)
+        SELECT user_id, category_id, type, date_trunc('month', date)::date, SUM(amount), COUNT(*)
+        FROM transactions
+        WHERE category_id IS NOT NULL
+        GROUP BY user_id, category_id, type, date_trunc('month', date)::date
+    """)
+
+
+def downgrade():
+    """Удалить таблицу category_month_stats."""
+    op.drop_table('category_month_stats')
@@ -0,0 +1,46 @@
+"""Store transaction type as SMALLINT instead of native enum
+
+Revision ID: 011
+Revises: 010
+Create Date: 2026-10-15 10:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '011'
+down_revision = '010'
+branch_labels = None
+depends_on = None
+
+# Таблицы со столбцом type (0 — INCOME, 1 — EXPENSE)
+TYPE_TABLES = ['categories', 'transactions', 'category_month_stats']
+
+
+def upgrade():
+    """Перевести столбцы type с enum transactiontype на SMALLINT."""
+    for table in TYPE_TABLES:
+        op.alter_column(
+            table, 'type',
+            type_=sa.SmallInteger(),
+            existing_type=postgresql.ENUM('INCOME', 'EXPENSE', name='transactiontype', create_type=False),
+            existing_nullable=False,
+            postgresql_using="CASE type WHEN 'INCOME' THEN 0 ELSE 1 END"
+        )
+    op.execute('DROP TYPE IF EXISTS transactiontype')
+
+
+def downgrade():
+    """Вернуть столбцы type к enum transactiontype."""
+    transaction_type = postgresql.ENUM('INCOME', 'EXPENSE', name='transactiontype')
+    transaction_type.create(op.get_bind(), checkfirst=True)
+    for table in TYPE_TABLES:
+        op.alter_column(
+            table, 'type',
+            type_=transaction_type,
+            existing_type=sa.SmallInteger(),
+            existing_nullable=False,
+            postgresql_using="(CASE type WHEN 0 THEN 'INCOME' ELSE 'EXPENSE' END)::transactiontype"
+        )
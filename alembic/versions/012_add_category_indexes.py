@@ -0,0 +1,42 @@
+"""Add category lookup indexes
+
+Revision ID: 012
+Revises: 011
+Create Date: 2026-10-15 10:35:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '012'
+down_revision = '011'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Создать индексы для выборки категорий и транзакций по категории (без блокировки записи)."""
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_cat_user_type',
+            'categories',
+            ['user_id', 'type'],
+            unique=False,
+            postgresql_concurrently=True
+        )
+        op.create_index(
+            'ix_tx_user_cat',
+            'transactions',
+            ['user_id', 'category_id'],
+            unique=False,
+            postgresql_where=sa.text('category_id IS NOT NULL'),
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    """Удалить индексы категорий."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tx_user_cat', table_name='transactions', postgresql_concurrently=True)
+        op.drop_index('ix_cat_user_type', table_name='categories', postgresql_concurrently=True)
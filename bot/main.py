@@ -1,6 +1,10 @@
 """Основной файл Telegram бота."""
 import asyncio
+import os
+import time
+from pathlib import PurePosixPath
 from telegram import Update
+from telegram.error import Conflict, NetworkError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -13,7 +17,7 @@ from telegram.ext import (
 from telegram.constants import ParseMode
 from database.connection import SessionLocal
 from database.crud import (
-    get_or_create_user,
+    get_or_create_user_id,
     get_categories_by_user,
     get_category_by_id,
     create_transaction,
@@ -23,12 +27,14 @@ from database.crud import (
     get_average_daily_expense,
     update_user_settings,
     get_user_settings,
+    get_user_context,
     get_transaction_by_id,
     update_transaction,
     delete_transaction,
     bulk_create_transactions,
     get_merchant_rule,
     create_merchant_rule,
+    get_merchant_rule_categories,
     create_receipt,
     find_matching_transactions,
     attach_receipt_to_transaction
@@ -37,20 +43,20 @@ from database.models import TransactionType as TType
 from utils.default_categories import create_default_categories
 from utils.helpers import format_amount, format_date, parse_amount
 from utils.statement_parser import (
-    parse_pdf_statement,
+    parse_pdf_statement_async,
     parse_csv_statement,
     parse_excel_statement,
-    categorize_transactions_batch
+    categorize_transactions_batch_async
 )
 from utils.text_parser import parse_transaction_text, normalize_merchant_name
-from utils.auto_categorizer import auto_categorize_transaction, suggest_merchant_description
+from utils.auto_categorizer import auto_categorize_transaction_async, suggest_merchant_description
 from utils.periods import (
     get_period_boundaries,
     get_period_name,
     calculate_period_comparison,
     format_comparison_text
 )
-from utils.receipt_processor import process_receipt_image
+from utils.receipt_processor import process_receipt_image_stream
 from bot.keyboards import (
     get_main_menu_keyboard,
     get_categories_inline_keyboard,
@@ -67,13 +73,29 @@ from config.settings import settings
 from loguru import logger
 from datetime import datetime, date, timedelta
 from typing import Dict, Any
-from ai.claude_client import ClaudeClient
+from ai.claude_client import get_claude_client
+
+try:
+    import fcntl
+except ImportError:  # Windows: lock-файл не поддерживается
+    fcntl = None
 
 # Состояния для ConversationHandler
 AMOUNT, CATEGORY, DESCRIPTION, CONFIRM = range(4)
 # Состояния для редактирования транзакции
 EDIT_AMOUNT, EDIT_CATEGORY, EDIT_DATE, EDIT_DESCRIPTION, EDIT_CONFIRM = range(4, 9)
 
+# Подсказка после завершения действия. Главное меню — постоянная reply-клавиатура,
+# которая уже показана пользователю, поэтому отдельное сообщение с ней не нужно:
+# дописываем подсказку в редактируемое сообщение (один запрос к API вместо двух)
+MENU_HINT = "\n\nВыбери действие из меню:"
+
+# Поддерживаемые форматы файлов выписок
+SUPPORTED_STATEMENT_FORMATS = frozenset({"pdf", "csv", "xlsx", "xls"})
+
+# Число попыток запуска бота при сетевых ошибках и конфликтах getUpdates
+STARTUP_ATTEMPTS = 6
+
 
 class BotState:
     """Хранилище состояния бота."""
@@ -101,12 +123,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id, user.username)
+        db_user_id = get_or_create_user_id(db, user.id, user.username)
         
         # Создаем категории по умолчанию, если их нет
-        categories = get_categories_by_user(db, db_user.id)
+        categories = get_categories_by_user(db, db_user_id)
         if not categories:
-            create_default_categories(db, db_user.id)
+            create_default_categories(db, db_user_id)
+            db.commit()
             await update.message.reply_text(
                 "✅ Созданы категории по умолчанию!"
             )
@@ -144,18 +167,18 @@ async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         # Общий баланс
-        total_balance = get_balance(db, db_user.id)
+        total_balance = get_balance(db, db_user_id)
         
         # Баланс за текущий месяц
         today = date.today()
         first_day = date(today.year, today.month, 1)
-        month_balance = get_balance(db, db_user.id, start_date=first_day, end_date=today)
+        month_balance = get_balance(db, db_user_id, start_date=first_day, end_date=today)
         
         # Последние 5 транзакций
-        recent_transactions = get_transactions_by_user(db, db_user.id, limit=5)
+        recent_transactions = get_transactions_by_user(db, db_user_id, limit=5)
         
         balance_text = f"""
 💰 <b>Твой баланс</b>
@@ -248,8 +271,8 @@ async def process_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Показываем категории
     db = SessionLocal()
     try:
-        db_user = get_or_create_user(db, update.effective_user.id)
-        categories = get_categories_by_user(db, db_user.id, transaction_type=transaction_type)
+        db_user_id = get_or_create_user_id(db, update.effective_user.id)
+        categories = get_categories_by_user(db, db_user_id, transaction_type=transaction_type)
         
         if not categories:
             await update.message.reply_text("❌ Нет категорий. Сначала создай категории.")
@@ -369,16 +392,17 @@ async def confirm_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         logger.info(f"Создание транзакции: тип={pending['type']}, сумма={pending['amount']}")
         
-        db_user = get_or_create_user(db, update.effective_user.id)
+        db_user_id = get_or_create_user_id(db, update.effective_user.id)
         
         transaction = create_transaction(
             db=db,
-            user_id=db_user.id,
+            user_id=db_user_id,
             transaction_type=pending["type"],
             amount=pending["amount"],
             category_id=pending.get("category_id"),
             description=pending.get("description")
         )
+        db.commit()
         
         logger.info(f"Транзакция создана: ID {transaction.id}, сумма {transaction.amount}")
         
@@ -432,8 +456,8 @@ async def handle_history_period(update: Update, context: ContextTypes.DEFAULT_TY
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
-        user_settings = get_user_settings(db, db_user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
+        user_settings = get_user_settings(db, db_user_id)
         
         # Получаем начало месяца из настроек
         month_start = user_settings.get("month_start", 1)
@@ -443,7 +467,7 @@ async def handle_history_period(update: Update, context: ContextTypes.DEFAULT_TY
         period_name = get_period_name(period_type, start_date, end_date)
         
         # Получаем транзакции за период
-        transactions = get_transactions_by_user(db, db_user.id, start_date=start_date, end_date=end_date, limit=50)
+        transactions = get_transactions_by_user(db, db_user_id, start_date=start_date, end_date=end_date, limit=50)
         
         if not transactions:
             await query.edit_message_text(
@@ -502,9 +526,9 @@ async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
-        categories = get_categories_by_user(db, db_user.id)
+        categories = get_categories_by_user(db, db_user_id)
         
         if not categories:
             await update.message.reply_text(
@@ -564,8 +588,8 @@ async def handle_statistics_period(update: Update, context: ContextTypes.DEFAULT
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
-        user_settings = get_user_settings(db, db_user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
+        user_settings = get_user_settings(db, db_user_id)
         
         # Получаем начало месяца из настроек
         month_start = user_settings.get("month_start", 1)
@@ -574,19 +598,23 @@ async def handle_statistics_period(update: Update, context: ContextTypes.DEFAULT
         start_date, end_date = get_period_boundaries(period_type, month_start)
         period_name = get_period_name(period_type, start_date, end_date)
         
-        # Общая статистика за период
-        period_stats = get_balance(db, db_user.id, start_date=start_date, end_date=end_date)
-        
-        # Статистика по категориям
-        expense_stats = get_statistics_by_category(
-            db, db_user.id, TType.EXPENSE, start_date=start_date, end_date=end_date
-        )
-        income_stats = get_statistics_by_category(
-            db, db_user.id, TType.INCOME, start_date=start_date, end_date=end_date
-        )
+        def collect_period_stats():
+            return (
+                # Общая статистика за период
+                get_balance(db, db_user_id, start_date=start_date, end_date=end_date),
+                # Статистика по категориям
+                get_statistics_by_category(
+                    db, db_user_id, TType.EXPENSE, start_date=start_date, end_date=end_date
+                ),
+                get_statistics_by_category(
+                    db, db_user_id, TType.INCOME, start_date=start_date, end_date=end_date
+                ),
+                # Средний дневной расход
+                get_average_daily_expense(db, db_user_id, start_date=start_date, end_date=end_date)
+            )
         
-        # Средний дневной расход
-        avg_daily = get_average_daily_expense(db, db_user.id, start_date=start_date, end_date=end_date)
+        # Агрегирующие запросы выполняем в потоке, чтобы не блокировать event loop
+        period_stats, expense_stats, income_stats, avg_daily = await asyncio.to_thread(collect_period_stats)
         
         stats_text = f"""📈 <b>Статистика: {period_name}</b>
 
@@ -615,7 +643,9 @@ async def handle_statistics_period(update: Update, context: ContextTypes.DEFAULT
         # Сравнение с предыдущим периодом (только для current)
         if period_type == "current":
             prev_start_date, prev_end_date = get_period_boundaries("previous", month_start)
-            previous_stats = get_balance(db, db_user.id, start_date=prev_start_date, end_date=prev_end_date)
+            previous_stats = await asyncio.to_thread(
+                get_balance, db, db_user_id, start_date=prev_start_date, end_date=prev_end_date
+            )
             
             comparison = calculate_period_comparison(period_stats, previous_stats)
             comparison_text = format_comparison_text(comparison, user_settings)
@@ -660,7 +690,7 @@ async def handle_ai_question(update: Update, context: ContextTypes.DEFAULT_TYPE)
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         question = update.message.text
         
@@ -669,14 +699,14 @@ async def handle_ai_question(update: Update, context: ContextTypes.DEFAULT_TYPE)
         first_day = date(today.year, today.month, 1)
         
         # Статистика за месяц
-        month_stats = get_balance(db, db_user.id, start_date=first_day, end_date=today)
+        month_stats = get_balance(db, db_user_id, start_date=first_day, end_date=today)
         
         # Последние транзакции
-        recent_transactions = get_transactions_by_user(db, db_user.id, limit=10)
+        recent_transactions = get_transactions_by_user(db, db_user_id, limit=10)
         
         # Статистика по категориям
         expense_stats = get_statistics_by_category(
-            db, db_user.id, TType.EXPENSE, start_date=first_day, end_date=today
+            db, db_user_id, TType.EXPENSE, start_date=first_day, end_date=today
         )
         
         # Формируем контекст для Claude
@@ -701,7 +731,7 @@ async def handle_ai_question(update: Update, context: ContextTypes.DEFAULT_TYPE)
             context_data += f" - {format_date(trans.date)}\n"
         
         # Отправляем запрос в Claude
-        claude = ClaudeClient()
+        claude = get_claude_client()
         
         prompt = f"""Ты финансовый ассистент. Пользователь задал вопрос о своих финансах.
 
@@ -714,7 +744,7 @@ async def handle_ai_question(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         await update.message.reply_text("🤔 Думаю...")
         
-        response = claude.get_completion(prompt, max_tokens=512)
+        response = await claude.aget_completion(prompt, max_tokens=512)
         
         await update.message.reply_text(
             f"🤖 *AI Ассистент*\n\n{response}",
@@ -741,10 +771,10 @@ async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         # Получаем текущие настройки
-        settings = get_user_settings(db, db_user.id)
+        settings = get_user_settings(db, db_user_id)
         currency = settings.get("currency", "RUB")
         month_start = settings.get("month_start", 1)
         
@@ -778,7 +808,7 @@ async def handle_transaction_callback(update: Update, context: ContextTypes.DEFA
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         callback_data = query.data
         
@@ -786,7 +816,7 @@ async def handle_transaction_callback(update: Update, context: ContextTypes.DEFA
             transaction_id = int(callback_data.split("_")[2])
             transaction = get_transaction_by_id(db, transaction_id)
             
-            if not transaction or transaction.user_id != db_user.id:
+            if not transaction or transaction.user_id != db_user_id:
                 await query.edit_message_text("❌ Транзакция не найдена.")
                 return
             
@@ -825,21 +855,18 @@ async def handle_transaction_callback(update: Update, context: ContextTypes.DEFA
             transaction_id = int(callback_data.split("_")[2])
             transaction = get_transaction_by_id(db, transaction_id)
             
-            if not transaction or transaction.user_id != db_user.id:
+            if not transaction or transaction.user_id != db_user_id:
                 await query.edit_message_text("❌ Транзакция не найдена.")
                 return
             
             # Удаляем транзакцию
             delete_transaction(db, transaction_id)
+            db.commit()
             
             await query.edit_message_text(
-                "✅ Транзакция удалена!",
+                "✅ Транзакция удалена!" + MENU_HINT,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             return
         
     except Exception as e:
@@ -857,7 +884,7 @@ async def handle_edit_transaction_callback(update: Update, context: ContextTypes
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         transaction_id = context.user_data.get("editing_transaction_id")
         if not transaction_id:
@@ -865,7 +892,7 @@ async def handle_edit_transaction_callback(update: Update, context: ContextTypes
             return ConversationHandler.END
         
         transaction = get_transaction_by_id(db, transaction_id)
-        if not transaction or transaction.user_id != db_user.id:
+        if not transaction or transaction.user_id != db_user_id:
             await query.edit_message_text("❌ Транзакция не найдена.")
             return ConversationHandler.END
         
@@ -880,7 +907,7 @@ async def handle_edit_transaction_callback(update: Update, context: ContextTypes
             return EDIT_AMOUNT
         
         elif callback_data == "edit_field_category":
-            categories = get_categories_by_user(db, db_user.id, transaction_type=transaction.type)
+            categories = get_categories_by_user(db, db_user_id, transaction_type=transaction.type)
             if not categories:
                 await query.edit_message_text("❌ Нет доступных категорий.")
                 return ConversationHandler.END
@@ -920,6 +947,7 @@ async def handle_edit_transaction_callback(update: Update, context: ContextTypes
                 date=editing_data.get("date"),
                 description=editing_data.get("description")
             )
+            db.commit()
             
             # Очищаем данные редактирования
             context.user_data.pop("editing_transaction_id", None)
@@ -927,13 +955,9 @@ async def handle_edit_transaction_callback(update: Update, context: ContextTypes
             context.user_data.pop("editing_field", None)
             
             await query.edit_message_text(
-                "✅ Транзакция успешно обновлена!",
+                "✅ Транзакция успешно обновлена!" + MENU_HINT,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             return ConversationHandler.END
         
         elif callback_data == "edit_cancel":
@@ -943,13 +967,9 @@ async def handle_edit_transaction_callback(update: Update, context: ContextTypes
             context.user_data.pop("editing_field", None)
             
             await query.edit_message_text(
-                "❌ Редактирование отменено.",
+                "❌ Редактирование отменено." + MENU_HINT,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             return ConversationHandler.END
         
     except Exception as e:
@@ -1071,19 +1091,15 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         callback_data = query.data
         
         if callback_data == "settings_back":
             await query.edit_message_text(
-                "⚙️ Настройки закрыты.",
+                "⚙️ Настройки закрыты." + MENU_HINT,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             return
         
         elif callback_data == "setting_currency":
@@ -1113,30 +1129,24 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
             }
             symbol = currency_symbols.get(currency_code, currency_code)
             
-            update_user_settings(db, db_user.id, {"currency": currency_code})
+            update_user_settings(db, db_user_id, {"currency": currency_code})
+            db.commit()
             
             await query.edit_message_text(
-                f"✅ Валюта изменена на {symbol} {currency_code}",
+                f"✅ Валюта изменена на {symbol} {currency_code}" + MENU_HINT,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             return
         
         elif callback_data.startswith("month_start_"):
             day = int(callback_data.split("_")[2])
-            update_user_settings(db, db_user.id, {"month_start": day})
+            update_user_settings(db, db_user_id, {"month_start": day})
+            db.commit()
             
             await query.edit_message_text(
-                f"✅ Начало месяца установлено на {day} число",
+                f"✅ Начало месяца установлено на {day} число" + MENU_HINT,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             return
         
     except Exception as e:
@@ -1154,9 +1164,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
-        await update.message.reply_text("📸 Обрабатываю чек...")
+        status_message = await update.message.reply_text("📸 Обрабатываю чек...")
         
         # Получаем самое качественное фото
         photo = update.message.photo[-1]
@@ -1170,15 +1180,30 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file = await context.bot.get_file(photo.file_id)
         photo_bytes = await file.download_as_bytearray()
         
-        # Получаем категории пользователя
-        categories = get_categories_by_user(db, db_user.id)
+        # Категории и настройки пользователя — одним запросом
+        user_context = get_user_context(db, db_user_id)
+        categories = user_context.categories
         categories_list = [
             {"name": cat.name, "icon": cat.icon, "type": cat.type.value}
             for cat in categories
         ]
         
-        # Обрабатываем чек через Claude
-        receipt_data = process_receipt_image(bytes(photo_bytes), categories_list)
+        user_settings = user_context.settings
+        
+        async def show_receipt_header(header: dict):
+            """Показать магазин и сумму, пока Claude распознаёт товары."""
+            await status_message.edit_text(
+                f"📸 <b>Чек</b>\n\n"
+                f"🏪 <b>Магазин:</b> {header.get('store_name') or 'Не указан'}\n"
+                f"💰 <b>Сумма:</b> {format_amount(header['total_amount'], user_settings=user_settings)}\n\n"
+                f"⏳ Распознаю товары...",
+                parse_mode=ParseMode.HTML
+            )
+        
+        # Обрабатываем чек через Claude (шапка чека показывается до списка товаров)
+        receipt_data = await process_receipt_image_stream(
+            bytes(photo_bytes), categories_list, on_header=show_receipt_header
+        )
         
         if not receipt_data:
             await update.message.reply_text(
@@ -1190,7 +1215,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Создаём чек в БД
         receipt = create_receipt(
             db=db,
-            user_id=db_user.id,
+            user_id=db_user_id,
             total_amount=receipt_data["total_amount"],
             store_name=receipt_data.get("store_name"),
             receipt_date=receipt_data.get("receipt_date"),
@@ -1200,6 +1225,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             items=receipt_data.get("items"),
             raw_data=receipt_data.get("raw_data")
         )
+        db.commit()
         
         # Сохраняем данные для дальнейшей обработки
         context.user_data["pending_receipt"] = {
@@ -1210,13 +1236,11 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Ищем подходящие транзакции
         matching_transactions = find_matching_transactions(
             db=db,
-            user_id=db_user.id,
+            user_id=db_user_id,
             amount=receipt_data["total_amount"],
             receipt_date=receipt_data["receipt_date"].date()
         )
         
-        user_settings = get_user_settings(db, db_user.id)
-        
         # Формируем предпросмотр
         preview_text = f"""📸 <b>Распознан чек</b>
 
@@ -1296,11 +1320,9 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Определяем тип файла
-    file_name = document.file_name.lower() if document.file_name else ""
-    file_extension = file_name.split(".")[-1] if "." in file_name else ""
+    file_extension = PurePosixPath(document.file_name or "").suffix[1:].lower()
     
-    supported_formats = ["pdf", "csv", "xlsx", "xls"]
-    if file_extension not in supported_formats:
+    if file_extension not in SUPPORTED_STATEMENT_FORMATS:
         await update.message.reply_text(
             f"❌ Неподдерживаемый формат файла.\n\nПоддерживаемые форматы: PDF, CSV, Excel (.xlsx, .xls)"
         )
@@ -1309,11 +1331,11 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
-        # Получаем категории пользователя для категоризации
-        categories = get_categories_by_user(db, db_user.id)
-        categories_list = [{"name": cat.name, "icon": cat.icon} for cat in categories]
+        # Категории (для категоризации) и настройки пользователя — одним запросом
+        user_context = get_user_context(db, db_user_id)
+        categories_list = [{"name": cat.name, "icon": cat.icon} for cat in user_context.categories]
         
         await update.message.reply_text("📄 Обрабатываю файл выписки...")
         
@@ -1325,16 +1347,21 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         transactions = []
         
         if file_extension == "pdf":
-            transactions = parse_pdf_statement(bytes(file_bytes), categories_list)
+            transactions = await parse_pdf_statement_async(bytes(file_bytes), categories_list)
         elif file_extension == "csv":
-            transactions = parse_csv_statement(bytes(file_bytes))
-            # Категоризируем через Claude если категории не определены
+            # Разбор таблиц (pandas) — в потоке, чтобы не блокировать event loop
+            transactions = await asyncio.to_thread(parse_csv_statement, bytes(file_bytes))
+            # Категоризируем по правилам мерчантов, остальное — через Claude
             if transactions and not transactions[0].get("category_name"):
-                transactions = categorize_transactions_batch(transactions, categories_list)
+                transactions = await categorize_transactions_batch_async(
+                    transactions, categories_list, get_merchant_rule_categories(db, db_user_id)
+                )
         elif file_extension in ["xlsx", "xls"]:
-            transactions = parse_excel_statement(bytes(file_bytes))
+            transactions = await asyncio.to_thread(parse_excel_statement, bytes(file_bytes))
             if transactions and not transactions[0].get("category_name"):
-                transactions = categorize_transactions_batch(transactions, categories_list)
+                transactions = await categorize_transactions_batch_async(
+                    transactions, categories_list, get_merchant_rule_categories(db, db_user_id)
+                )
         
         if not transactions:
             await update.message.reply_text(
@@ -1350,8 +1377,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         total_income = sum(t["amount"] for t in transactions if t["type"] == "income")
         total_expense = sum(t["amount"] for t in transactions if t["type"] == "expense")
         
-        # Получаем настройки пользователя для форматирования
-        user_settings = get_user_settings(db, db_user.id)
+        # Настройки пользователя для форматирования
+        user_settings = user_context.settings
         
         # Формируем предпросмотр
         preview_text = f"""
@@ -1404,7 +1431,7 @@ async def handle_import_callback(update: Update, context: ContextTypes.DEFAULT_T
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         callback_data = query.data
         transactions = context.user_data.get("pending_import", [])
@@ -1417,9 +1444,6 @@ async def handle_import_callback(update: Update, context: ContextTypes.DEFAULT_T
             # Массовое добавление всех транзакций
             await query.edit_message_text("⏳ Добавляю транзакции...")
             
-            # Преобразуем категории из имен в ID
-            categories_dict = {cat.name: cat.id for cat in get_categories_by_user(db, db_user.id)}
-            
             transactions_to_import = []
             for trans in transactions:
                 # Логируем тип транзакции для отладки
@@ -1434,9 +1458,11 @@ async def handle_import_callback(update: Update, context: ContextTypes.DEFAULT_T
                 }
                 transactions_to_import.append(trans_data)
             
-            created_count, skipped_count = bulk_create_transactions(
-                db, db_user.id, transactions_to_import
+            # Массовая вставка — в потоке, чтобы не блокировать event loop
+            created_count, skipped_count = await asyncio.to_thread(
+                bulk_create_transactions, db, db_user_id, transactions_to_import
             )
+            await asyncio.to_thread(db.commit)
             
             result_text = f"""
 ✅ <b>Импорт завершен!</b>
@@ -1448,14 +1474,10 @@ async def handle_import_callback(update: Update, context: ContextTypes.DEFAULT_T
             """
             
             await query.edit_message_text(
-                result_text,
+                result_text.rstrip() + MENU_HINT,
                 parse_mode=ParseMode.HTML,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             
             # Очищаем данные импорта
             context.user_data.pop("pending_import", None)
@@ -1470,13 +1492,9 @@ async def handle_import_callback(update: Update, context: ContextTypes.DEFAULT_T
         elif callback_data == "import_cancel":
             context.user_data.pop("pending_import", None)
             await query.edit_message_text(
-                "❌ Импорт отменен.",
+                "❌ Импорт отменен." + MENU_HINT,
                 reply_markup=None
             )
-            await query.message.reply_text(
-                "Выбери действие из меню:",
-                reply_markup=get_main_menu_keyboard()
-            )
             
     except Exception as e:
         logger.error(f"Ошибка при импорте транзакций: {e}")
@@ -1490,7 +1508,7 @@ async def handle_quick_transaction(update: Update, context: ContextTypes.DEFAULT
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         amount = parsed_data["amount"]
         transaction_type = parsed_data["type"]
@@ -1499,8 +1517,9 @@ async def handle_quick_transaction(update: Update, context: ContextTypes.DEFAULT
         
         logger.info(f"Быстрая транзакция от пользователя {user.id}: {transaction_type} {amount} {merchant}")
         
-        # Получаем категории пользователя
-        categories = get_categories_by_user(db, db_user.id)
+        # Категории и настройки пользователя — одним запросом
+        user_context = get_user_context(db, db_user_id)
+        categories = user_context.categories
         categories_list = [
             {
                 "id": cat.id,
@@ -1515,7 +1534,7 @@ async def handle_quick_transaction(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_chat_action("typing")
         
         # Проверяем, есть ли сохранённое правило для этого мерчанта
-        merchant_rule = get_merchant_rule(db, db_user.id, normalized_merchant)
+        merchant_rule = get_merchant_rule(db, db_user_id, normalized_merchant)
         
         if merchant_rule:
             # Используем сохранённое правило
@@ -1528,7 +1547,7 @@ async def handle_quick_transaction(update: Update, context: ContextTypes.DEFAULT
             result_text = f"✨ <b>Применено правило для '{merchant}'</b>\n\n"
         else:
             # Автокатегоризация через Claude
-            categorization = auto_categorize_transaction(
+            categorization = await auto_categorize_transaction_async(
                 merchant=merchant,
                 description=merchant,
                 user_categories=categories_list,
@@ -1561,8 +1580,8 @@ async def handle_quick_transaction(update: Update, context: ContextTypes.DEFAULT
             "has_rule": merchant_rule is not None
         }
         
-        # Получаем настройки для форматирования
-        user_settings = get_user_settings(db, db_user.id)
+        # Настройки для форматирования
+        user_settings = user_context.settings
         
         # Формируем предпросмотр
         type_emoji = "➕" if transaction_type == "income" else "➖"
@@ -1610,7 +1629,7 @@ async def handle_quick_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         transaction_data = context.user_data.get("quick_transaction")
         if not transaction_data:
@@ -1620,15 +1639,16 @@ async def handle_quick_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
         # Создаём транзакцию
         transaction = create_transaction(
             db=db,
-            user_id=db_user.id,
+            user_id=db_user_id,
             transaction_type=transaction_data["type"],
             amount=transaction_data["amount"],
             category_id=transaction_data["category_id"],
             description=transaction_data["description"],
             date=date.today()
         )
+        db.commit()
         
-        user_settings = get_user_settings(db, db_user.id)
+        user_settings = get_user_settings(db, db_user_id)
         
         # Если правила ещё нет, спрашиваем, сохранить ли
         if not transaction_data.get("has_rule"):
@@ -1685,7 +1705,7 @@ async def handle_save_merchant_rule(update: Update, context: ContextTypes.DEFAUL
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
         
         # Извлекаем ID транзакции из callback_data
         transaction_id = int(query.data.split("_")[-1])
@@ -1698,11 +1718,12 @@ async def handle_save_merchant_rule(update: Update, context: ContextTypes.DEFAUL
         # Создаём правило для мерчанта
         merchant_rule = create_merchant_rule(
             db=db,
-            user_id=db_user.id,
+            user_id=db_user_id,
             merchant_name=transaction_data["normalized_merchant"],
             category_id=transaction_data["category_id"],
             default_description=transaction_data["description"]
         )
+        db.commit()
         
         merchant = transaction_data.get("merchant", "")
         category = get_category_by_id(db, transaction_data["category_id"])
@@ -1742,8 +1763,8 @@ async def handle_receipt_callback(update: Update, context: ContextTypes.DEFAULT_
     db = SessionLocal()
     try:
         user = update.effective_user
-        db_user = get_or_create_user(db, user.id)
-        user_settings = get_user_settings(db, db_user.id)
+        db_user_id = get_or_create_user_id(db, user.id)
+        user_settings = get_user_settings(db, db_user_id)
         
         receipt_data = context.user_data.get("pending_receipt")
         if not receipt_data:
@@ -1759,6 +1780,7 @@ async def handle_receipt_callback(update: Update, context: ContextTypes.DEFAULT_
             logger.info(f"Прикрепление чека {receipt_id} к существующей транзакции {transaction_id}")
             
             attach_receipt_to_transaction(db, receipt_id, transaction_id)
+            db.commit()
             
             # Получаем информацию о транзакции
             transaction = get_transaction_by_id(db, transaction_id)
@@ -1784,7 +1806,7 @@ async def handle_receipt_callback(update: Update, context: ContextTypes.DEFAULT_
             # Находим категорию по предложенному названию
             category_id = None
             suggested_category = data.get("suggested_category", "Прочее")
-            categories = get_categories_by_user(db, db_user.id)
+            categories = get_categories_by_user(db, db_user_id)
             for cat in categories:
                 if cat.name == suggested_category and cat.type == TType.EXPENSE:
                     category_id = cat.id
@@ -1802,7 +1824,7 @@ async def handle_receipt_callback(update: Update, context: ContextTypes.DEFAULT_
             # Создаём транзакцию
             transaction = create_transaction(
                 db=db,
-                user_id=db_user.id,
+                user_id=db_user_id,
                 transaction_type="expense",
                 amount=data["total_amount"],
                 category_id=category_id,
@@ -1814,6 +1836,7 @@ async def handle_receipt_callback(update: Update, context: ContextTypes.DEFAULT_
             
             # Прикрепляем чек
             attach_receipt_to_transaction(db, receipt_id, transaction.id)
+            db.commit()
             
             category_name = None
             if category_id:
@@ -1956,6 +1979,24 @@ def create_edit_transaction_conversation():
     )
 
 
+def _acquire_instance_lock():
+    """Захватить lock-файл процесса.
+    
+    Возвращает открытый файл (держать до выхода), False если lock занят
+    другим процессом, None если блокировки не поддерживаются платформой.
+    """
+    if fcntl is None:
+        return None
+    os.makedirs("logs", exist_ok=True)
+    lock_file = open("logs/bot.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    return lock_file
+
+
 def main():
     """Запустить бота."""
     # Настройка логирования
@@ -1982,56 +2023,41 @@ def main():
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
-    # Запуск бота
+    # Только один экземпляр бота на хост: второй poller вызывает Conflict getUpdates
+    instance_lock = _acquire_instance_lock()
+    if instance_lock is False:
+        logger.error("Бот уже запущен другим процессом (заблокирован logs/bot.lock), выходим")
+        return
+    
+    # Webhook — для продакшена (Railway), polling — для разработки
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        run_application = lambda: application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8000")),
+            webhook_url=webhook_url,
+            drop_pending_updates=True
+        )
+    else:
+        run_application = lambda: application.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,  # Игнорировать старые обновления при перезапуске
+            close_loop=False  # Не закрывать event loop при ошибках
+        )
+    
+    # Запуск бота с экспоненциальной задержкой между попытками
     logger.info("Бот запущен")
-    try:
-        # Используем webhook на Railway вместо polling для избежания конфликтов
-        # Но если webhook не настроен, используем polling с обработкой конфликтов
-        import os
-        webhook_url = os.getenv("WEBHOOK_URL")
-        
-        if webhook_url:
-            # Webhook режим для продакшена
-            application.run_webhook(
-                listen="0.0.0.0",
-                port=int(os.getenv("PORT", "8000")),
-                webhook_url=webhook_url,
-                drop_pending_updates=True
-            )
-        else:
-            # Polling режим для разработки
-            application.run_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True,  # Игнорировать старые обновления при перезапуске
-                close_loop=False  # Не закрывать event loop при ошибках
-            )
-    except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
-        # Не падаем при конфликте getUpdates - просто логируем и ждем
-        if "Conflict" in str(e) or "getUpdates" in str(e):
-            logger.warning("Конфликт getUpdates - возможно запущен другой экземпляр бота. Ожидание...")
-            import time
-            time.sleep(5)
-            # Пробуем еще раз
-            try:
-                if webhook_url:
-                    application.run_webhook(
-                        listen="0.0.0.0",
-                        port=int(os.getenv("PORT", "8000")),
-                        webhook_url=webhook_url,
-                        drop_pending_updates=True
-                    )
-                else:
-                    application.run_polling(
-                        allowed_updates=Update.ALL_TYPES,
-                        drop_pending_updates=True,
-                        close_loop=False
-                    )
-            except Exception as retry_error:
-                logger.error(f"Ошибка при повторной попытке запуска: {retry_error}")
+    for attempt in range(STARTUP_ATTEMPTS):
+        try:
+            run_application()
+            break
+        except (NetworkError, Conflict) as e:
+            if attempt == STARTUP_ATTEMPTS - 1:
+                logger.error(f"Не удалось запустить бота после {STARTUP_ATTEMPTS} попыток: {e}")
                 raise
-        else:
-            raise
+            delay = min(60, 2 ** attempt)
+            logger.warning(f"Ошибка при запуске бота: {e}. Повтор через {delay} с")
+            time.sleep(delay)
 
 
 if __name__ == "__main__":
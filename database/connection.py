@@ -7,7 +7,14 @@ from config.settings import settings
 # Создание движка SQLAlchemy
 engine = create_engine(
     settings.database_url,
+    # Одна сессия на обновление Telegram: пул рассчитан на параллельные обработчики
+    pool_size=20,
+    max_overflow=10,
     pool_pre_ping=True,
+    # Переоткрывать соединения раньше, чем их закроет сервер/прокси по простою
+    pool_recycle=1800,
+    # Кэш скомпилированных select()-запросов: CRUD-запросы компилируются один раз
+    query_cache_size=1200,
     echo=settings.environment == "development"
 )
 
@@ -1,46 +1,115 @@
-"""CRUD операции для работы с базой данных."""
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+"""CRUD операции для работы с базой данных.
+
+Функции изменения данных не фиксируют транзакцию (только flush):
+commit выполняет вызывающий обработчик один раз за обновление.
+"""
+import csv
+import io
+import threading
+from dataclasses import dataclass
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import func, and_, or_, case, cast, literal, select, insert, update, delete, bindparam, lambda_stmt, tuple_, union_all
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from cachetools import LRUCache, TTLCache
 from datetime import datetime, date, timedelta
+from decimal import Decimal
 from typing import Optional, List, Dict, Any
-from database.models import User, Transaction, Category, Budget, TransactionType, BudgetPeriod, MerchantRule, Receipt
+from database.models import User, Transaction, Category, Budget, CachedBalance, CategoryMonthStats, TransactionType, TRANSACTION_TYPE_CODES, BudgetPeriod, MerchantRule, Receipt
 from loguru import logger
 
 
+def _upsert_insert(db: Session):
+    """insert() диалекта сессии с поддержкой ON CONFLICT."""
+    return sqlite_insert if db.get_bind().dialect.name == "sqlite" else pg_insert
+
+
 # ========== User CRUD ==========
 
+# Самые частые выборки одной строки: lambda_stmt кэширует построение запроса,
+# скомпилированный SQL и обработку результата на уровне процесса
+_USER_BY_TELEGRAM_ID = lambda_stmt(lambda: select(User).where(User.telegram_id == bindparam("tid")))
+_CATEGORY_BY_ID = lambda_stmt(lambda: select(Category).where(Category.id == bindparam("cid")))
+_TRANSACTION_BY_ID = lambda_stmt(lambda: select(Transaction).where(Transaction.id == bindparam("tid")))
+
+
 def get_user_by_telegram_id(db: Session, telegram_id: int) -> Optional[User]:
     """Получить пользователя по Telegram ID."""
-    return db.query(User).filter(User.telegram_id == telegram_id).first()
+    return db.execute(_USER_BY_TELEGRAM_ID, {"tid": telegram_id}).scalar_one_or_none()
 
 
 def create_user(db: Session, telegram_id: int, username: Optional[str] = None) -> User:
     """Создать нового пользователя."""
     user = User(telegram_id=telegram_id, username=username)
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    db.flush()
     return user
 
 
-def get_or_create_user(db: Session, telegram_id: int, username: Optional[str] = None) -> User:
-    """Получить пользователя или создать нового."""
-    user = get_user_by_telegram_id(db, telegram_id)
-    if not user:
-        user = create_user(db, telegram_id, username)
-    return user
+# Кэш telegram_id -> users.id. Храним только числовой id, а не ORM-объект:
+# объект привязан к сессии обработчика и после её закрытия становится detached.
+# id пользователя не меняется, поэтому инвалидация не требуется
+_user_id_cache: LRUCache = LRUCache(maxsize=10_000)
 
 
-def update_user_settings(db: Session, user_id: int, settings: dict) -> User:
-    """Обновить настройки пользователя."""
-    user = db.query(User).filter(User.id == user_id).first()
-    if user:
-        current_settings = user.settings if user.settings else {}
-        current_settings.update(settings)
-        user.settings = current_settings
-        db.commit()
-        db.refresh(user)
-    return user
+def get_or_create_user_id(db: Session, telegram_id: int, username: Optional[str] = None) -> int:
+    """Получить ID пользователя по Telegram ID, создав пользователя при необходимости.
+    
+    При попадании в кэш запросов к БД нет, иначе — один UPSERT ... RETURNING id.
+    """
+    user_id = _user_id_cache.get(telegram_id)
+    if user_id is not None:
+        return user_id
+    
+    stmt = _upsert_insert(db)(User).values(telegram_id=telegram_id, username=username)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        # Не затираем сохранённый username, если он не передан
+        set_={"username": func.coalesce(stmt.excluded.username, User.username)}
+    ).returning(User.id)
+    user_id = db.execute(stmt).scalar_one()
+    # Фиксируем сразу: id попадает в кэш и не должен откатиться вместе с обработчиком
+    db.commit()
+    
+    _user_id_cache[telegram_id] = user_id
+    return user_id
+
+
+# Слияние настроек на стороне PostgreSQL: settings || patch одним атомарным
+# UPDATE ... RETURNING, без чтения всего JSON в Python
+_MERGE_USER_SETTINGS = (
+    update(User)
+    .where(User.id == bindparam("uid"))
+    .values(settings=func.coalesce(User.settings, cast({}, JSONB)).op("||", return_type=JSONB)(
+        cast(bindparam("patch", type_=JSONB), JSONB)
+    ))
+    .returning(User.settings)
+    .execution_options(synchronize_session=False)
+)
+
+# Для остальных СУБД: чтение и запись настроек целиком
+_UPDATE_USER_SETTINGS = (
+    update(User)
+    .where(User.id == bindparam("uid"))
+    .values(settings=bindparam("new_settings"))
+    .execution_options(synchronize_session=False)
+)
+
+
+def update_user_settings(db: Session, user_id: int, settings: dict) -> Optional[dict]:
+    """Обновить настройки пользователя. Возвращает итоговые настройки."""
+    if db.get_bind().dialect.name == "postgresql":
+        return db.execute(_MERGE_USER_SETTINGS, {"uid": user_id, "patch": settings}).scalar_one_or_none()
+    
+    current_settings = db.execute(
+        select(User.settings).where(User.id == user_id)
+    ).one_or_none()
+    if current_settings is None:
+        return None
+    
+    new_settings = {**(current_settings.settings or {}), **settings}
+    db.execute(_UPDATE_USER_SETTINGS, {"uid": user_id, "new_settings": new_settings})
+    return new_settings
 
 
 def get_user_settings(db: Session, user_id: int) -> dict:
@@ -51,6 +120,24 @@ def get_user_settings(db: Session, user_id: int) -> dict:
     return {}
 
 
+@dataclass
+class UserContext:
+    """Данные пользователя, нужные большинству обработчиков."""
+    user: User
+    categories: List[Category]
+    settings: dict
+
+
+def get_user_context(db: Session, user_id: int) -> Optional[UserContext]:
+    """Получить пользователя вместе с категориями и настройками одним запросом."""
+    user = db.execute(
+        select(User).where(User.id == user_id).options(joinedload(User.categories))
+    ).unique().scalar_one_or_none()
+    if user is None:
+        return None
+    return UserContext(user=user, categories=list(user.categories), settings=user.settings or {})
+
+
 # ========== Category CRUD ==========
 
 def get_categories_by_user(db: Session, user_id: int, transaction_type: Optional[TransactionType] = None) -> List[Category]:
@@ -61,9 +148,43 @@ def get_categories_by_user(db: Session, user_id: int, transaction_type: Optional
     return query.all()
 
 
+# Кэш {user_id: {(тип, название в нижнем регистре): id}} для сопоставления
+# категорий по имени; сбрасывается при создании и удалении категорий.
+# Импорт выписки читает кэш из рабочего потока (asyncio.to_thread), а кэши
+# cachetools не потокобезопасны — все обращения к кэшу идут под блокировкой
+_category_ids_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_category_ids_lock = threading.Lock()
+
+
+def _invalidate_category_ids(user_id: int) -> None:
+    """Сбросить кэш ID категорий пользователя."""
+    with _category_ids_lock:
+        _category_ids_cache.pop(user_id, None)
+
+
+def get_category_ids_by_name(db: Session, user_id: int) -> Dict[tuple[TransactionType, str], int]:
+    """Получить ID категорий пользователя по (типу, названию в нижнем регистре).
+    
+    Тип входит в ключ, так как одно название (например "Прочее") бывает
+    и у категории доходов, и у категории расходов.
+    """
+    with _category_ids_lock:
+        category_ids = _category_ids_cache.get(user_id)
+    if category_ids is None:
+        category_ids = {
+            (row.type, row.name.lower()): row.id
+            for row in db.execute(
+                select(Category.id, Category.type, Category.name).where(Category.user_id == user_id)
+            )
+        }
+        with _category_ids_lock:
+            _category_ids_cache[user_id] = category_ids
+    return category_ids
+
+
 def get_category_by_id(db: Session, category_id: int) -> Optional[Category]:
     """Получить категорию по ID."""
-    return db.query(Category).filter(Category.id == category_id).first()
+    return db.execute(_CATEGORY_BY_ID, {"cid": category_id}).scalar_one_or_none()
 
 
 def create_category(db: Session, user_id: int, name: str, transaction_type: TransactionType, icon: str = "📁", is_default: bool = False) -> Category:
@@ -76,23 +197,135 @@ def create_category(db: Session, user_id: int, name: str, transaction_type: Tran
         is_default=is_default
     )
     db.add(category)
-    db.commit()
-    db.refresh(category)
+    db.flush()
+    _invalidate_category_ids(user_id)
     return category
 
 
+def create_categories(db: Session, user_id: int, categories_data: List[Dict[str, Any]], is_default: bool = False) -> List[Category]:
+    """Создать несколько категорий одним INSERT.
+    
+    categories_data: [{"name", "type", "icon"}]. Категории получают id после flush.
+    """
+    categories = [
+        Category(
+            user_id=user_id,
+            name=data["name"],
+            type=data["type"],
+            icon=data.get("icon", "📁"),
+            is_default=is_default
+        )
+        for data in categories_data
+    ]
+    db.add_all(categories)
+    db.flush()
+    _invalidate_category_ids(user_id)
+    return categories
+
+
 def delete_category(db: Session, category_id: int) -> bool:
     """Удалить категорию."""
     category = db.query(Category).filter(Category.id == category_id).first()
     if category:
+        db.execute(delete(CategoryMonthStats).where(CategoryMonthStats.category_id == category_id))
         db.delete(category)
-        db.commit()
+        db.flush()
+        _invalidate_category_ids(category.user_id)
         return True
     return False
 
 
 # ========== Transaction CRUD ==========
 
+_CENT = Decimal("0.01")
+
+
+def _to_money(amount) -> Decimal:
+    """Привести сумму к Decimal с точностью столбца amount (2 знака)."""
+    return Decimal(str(amount)).quantize(_CENT)
+
+
+def _apply_balance_delta(db: Session, user_id: int, income_delta: float = 0, expense_delta: float = 0) -> None:
+    """Изменить накопленные итоги пользователя в cached_balances (в текущей транзакции БД)."""
+    if not income_delta and not expense_delta:
+        return
+    stmt = _upsert_insert(db)(CachedBalance).values(
+        user_id=user_id, income_total=income_delta, expense_total=expense_delta
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[CachedBalance.user_id],
+        set_={
+            "income_total": CachedBalance.income_total + stmt.excluded.income_total,
+            "expense_total": CachedBalance.expense_total + stmt.excluded.expense_total,
+            "updated_at": func.now()
+        }
+    ))
+
+
+def _apply_transaction_aggregates(
+    db: Session,
+    user_id: int,
+    added: List[Dict[str, Any]] = (),
+    removed: List[Dict[str, Any]] = ()
+) -> None:
+    """Учесть добавленные и убранные транзакции в агрегатах пользователя.
+    
+    Обновляет cached_balances и category_month_stats в текущей транзакции БД.
+    Строки — словари с ключами type, amount, category_id, date.
+    """
+    income_delta = expense_delta = Decimal(0)
+    month_stats = {}
+    for rows, sign in ((added, 1), (removed, -1)):
+        for row in rows:
+            transaction_type = TransactionType(row["type"])
+            amount = _to_money(row["amount"]) * sign
+            if transaction_type == TransactionType.INCOME:
+                income_delta += amount
+            else:
+                expense_delta += amount
+            
+            if row["category_id"] is not None:
+                key = (row["category_id"], transaction_type, row["date"].replace(day=1))
+                total, count = month_stats.get(key, (0, 0))
+                month_stats[key] = (total + amount, count + sign)
+    
+    _apply_balance_delta(db, user_id, income_delta=income_delta, expense_delta=expense_delta)
+    
+    month_stats = {key: value for key, value in month_stats.items() if value != (0, 0)}
+    if month_stats:
+        stmt = _upsert_insert(db)(CategoryMonthStats).values([
+            {
+                "user_id": user_id,
+                "category_id": category_id,
+                "type": transaction_type,
+                "month": month,
+                "total": total,
+                "count": count
+            }
+            for (category_id, transaction_type, month), (total, count) in month_stats.items()
+        ])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[
+                CategoryMonthStats.user_id, CategoryMonthStats.category_id,
+                CategoryMonthStats.type, CategoryMonthStats.month
+            ],
+            set_={
+                "total": CategoryMonthStats.total + stmt.excluded.total,
+                "count": CategoryMonthStats.count + stmt.excluded.count
+            }
+        ))
+
+
+def _transaction_row(transaction: Transaction) -> Dict[str, Any]:
+    """Поля транзакции, от которых зависят агрегаты."""
+    return {
+        "type": transaction.type,
+        "amount": transaction.amount,
+        "category_id": transaction.category_id,
+        "date": transaction.date
+    }
+
+
 def create_transaction(
     db: Session,
     user_id: int,
@@ -117,11 +350,22 @@ def create_transaction(
         receipt_photo_url=receipt_photo_url
     )
     db.add(transaction)
-    db.commit()
-    db.refresh(transaction)
+    _apply_transaction_aggregates(db, user_id, added=[_transaction_row(transaction)])
+    db.flush()
     return transaction
 
 
+# Базовый запрос транзакций пользователя; фильтры добавляются только переданные,
+# поэтому каждая комбинация фильтров компилируется один раз и берётся из кэша
+# Категории подгружаются одним дополнительным SELECT ... IN на всю страницу,
+# а не ленивым запросом на каждую транзакцию при выводе списка
+_TRANSACTIONS_BY_USER = (
+    select(Transaction)
+    .where(Transaction.user_id == bindparam("user_id"))
+    .options(selectinload(Transaction.category))
+)
+
+
 def get_transactions_by_user(
     db: Session,
     user_id: int,
@@ -130,29 +374,36 @@ def get_transactions_by_user(
     end_date: Optional[date] = None,
     category_id: Optional[int] = None,
     limit: int = 50,
-    offset: int = 0
+    before: Optional[tuple[date, datetime]] = None
 ) -> List[Transaction]:
-    """Получить транзакции пользователя с фильтрами."""
-    query = db.query(Transaction).filter(Transaction.user_id == user_id)
+    """Получить транзакции пользователя с фильтрами.
+    
+    Пагинация по ключу: before — (date, created_at) последней полученной транзакции.
+    """
+    stmt = _TRANSACTIONS_BY_USER
     
     if transaction_type:
-        query = query.filter(Transaction.type == transaction_type)
+        stmt = stmt.where(Transaction.type == transaction_type)
     
     if start_date:
-        query = query.filter(Transaction.date >= start_date)
+        stmt = stmt.where(Transaction.date >= start_date)
     
     if end_date:
-        query = query.filter(Transaction.date <= end_date)
+        stmt = stmt.where(Transaction.date <= end_date)
     
     if category_id:
-        query = query.filter(Transaction.category_id == category_id)
+        stmt = stmt.where(Transaction.category_id == category_id)
     
-    return query.order_by(Transaction.date.desc(), Transaction.created_at.desc()).limit(limit).offset(offset).all()
+    if before:
+        stmt = stmt.where(tuple_(Transaction.date, Transaction.created_at) < tuple_(*before))
+    
+    stmt = stmt.order_by(Transaction.date.desc(), Transaction.created_at.desc()).limit(limit)
+    return list(db.execute(stmt, {"user_id": user_id}).scalars())
 
 
 def get_transaction_by_id(db: Session, transaction_id: int) -> Optional[Transaction]:
     """Получить транзакцию по ID."""
-    return db.query(Transaction).filter(Transaction.id == transaction_id).first()
+    return db.execute(_TRANSACTION_BY_ID, {"tid": transaction_id}).scalar_one_or_none()
 
 
 def update_transaction(
@@ -166,6 +417,7 @@ def update_transaction(
     """Обновить транзакцию."""
     transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
     if transaction:
+        old_row = _transaction_row(transaction)
         if amount is not None:
             transaction.amount = amount
         if category_id is not None:
@@ -174,8 +426,10 @@ def update_transaction(
             transaction.date = date
         if description is not None:
             transaction.description = description
-        db.commit()
-        db.refresh(transaction)
+        new_row = _transaction_row(transaction)
+        if new_row != old_row:
+            _apply_transaction_aggregates(db, transaction.user_id, added=[new_row], removed=[old_row])
+        db.flush()
         return transaction
     return None
 
@@ -184,12 +438,40 @@ def delete_transaction(db: Session, transaction_id: int) -> bool:
     """Удалить транзакцию."""
     transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
     if transaction:
+        _apply_transaction_aggregates(db, transaction.user_id, removed=[_transaction_row(transaction)])
         db.delete(transaction)
-        db.commit()
+        db.flush()
         return True
     return False
 
 
+_COPY_TRANSACTIONS_SQL = (
+    "COPY transactions (user_id, type, amount, category_id, date, description) "
+    "FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+)
+
+
+def _copy_transactions(db: Session, rows: List[Dict[str, Any]]) -> None:
+    """Вставить транзакции через COPY FROM STDIN (только PostgreSQL)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow((
+            row["user_id"],
+            TRANSACTION_TYPE_CODES[row["type"]],
+            row["amount"],
+            "\\N" if row["category_id"] is None else row["category_id"],
+            row["date"],
+            "\\N" if row["description"] is None else row["description"]
+        ))
+    buffer.seek(0)
+    
+    # Savepoint: при ошибке COPY откатывается только вставка, а не вся сессия
+    with db.begin_nested():
+        with db.connection().connection.cursor() as cursor:
+            cursor.copy_expert(_COPY_TRANSACTIONS_SQL, buffer)
+
+
 def bulk_create_transactions(
     db: Session,
     user_id: int,
@@ -200,79 +482,98 @@ def bulk_create_transactions(
     Returns:
         tuple: (количество созданных, количество пропущенных из-за дубликатов)
     """
-    created_count = 0
+    # Уже существующие транзакции пользователя за период выписки — одним
+    # запросом по индексу ix_tx_dedup. Ключ дубликата: тип, сумма, дата и
+    # описание (одна и та же сумма может быть и доходом и расходом)
+    dates = [t["date"] for t in transactions_data if t.get("date")]
+    existing = set(db.execute(
+        select(Transaction.type, Transaction.amount, Transaction.date, Transaction.description)
+        .where(Transaction.user_id == user_id, Transaction.date.between(min(dates), max(dates)))
+    ).all()) if dates else set()
+    
+    category_ids = get_category_ids_by_name(db, user_id)
+    
+    rows = []
     skipped_count = 0
     
     for trans_data in transactions_data:
         try:
-            # Проверяем на дубликаты (по сумме, дате, типу и описанию)
-            # Важно: учитываем тип транзакции, так как одна и та же сумма может быть и доходом и расходом
             transaction_type = TransactionType(trans_data["type"])
-            existing = db.query(Transaction).filter(
-                Transaction.user_id == user_id,
-                Transaction.type == transaction_type,
-                Transaction.amount == trans_data["amount"],
-                Transaction.date == trans_data["date"],
-                Transaction.description == trans_data.get("description", "")
-            ).first()
-            
-            if existing:
+            amount = _to_money(trans_data["amount"])
+            key = (
+                transaction_type,
+                amount,
+                trans_data["date"],
+                trans_data.get("description", "")
+            )
+            if key in existing:
                 logger.debug(f"Пропущена дубликат транзакции: {trans_data.get('description', '')[:50]} - {trans_data['amount']} на {trans_data['date']}")
                 skipped_count += 1
                 continue
             
-            # Находим категорию по имени
-            category_id = None
-            if trans_data.get("category_name"):
-                category = db.query(Category).filter(
-                    Category.user_id == user_id,
-                    Category.name == trans_data["category_name"]
-                ).first()
-                if category:
-                    category_id = category.id
-            
-            # Создаем транзакцию
-            transaction = Transaction(
-                user_id=user_id,
-                type=TransactionType(trans_data["type"]),
-                amount=trans_data["amount"],
-                category_id=category_id,
-                date=trans_data["date"],
-                description=trans_data.get("description")
-            )
-            db.add(transaction)
-            created_count += 1
+            rows.append({
+                "user_id": user_id,
+                "type": transaction_type,
+                "amount": amount,
+                "category_id": category_ids.get((transaction_type, (trans_data.get("category_name") or "").lower())),
+                "date": trans_data["date"],
+                "description": trans_data.get("description")
+            })
             
         except Exception as e:
             logger.error(f"Ошибка при создании транзакции: {e}")
             skipped_count += 1
             continue
     
-    db.commit()
+    if rows:
+        if db.get_bind().dialect.name == "postgresql":
+            _copy_transactions(db, rows)
+        else:
+            # Одна пакетная вставка (executemany / insertmanyvalues)
+            db.execute(insert(Transaction), rows)
+        _apply_transaction_aggregates(db, user_id, added=rows)
+    created_count = len(rows)
     return created_count, skipped_count
 
 
 def get_balance(db: Session, user_id: int, start_date: Optional[date] = None, end_date: Optional[date] = None) -> dict:
-    """Получить баланс пользователя."""
-    query = db.query(
-        Transaction.type,
-        func.sum(Transaction.amount).label('total')
-    ).filter(Transaction.user_id == user_id)
+    """Получить баланс пользователя.
+    
+    Баланс за всё время читается из cached_balances (одна строка),
+    за период — считается по транзакциям.
+    """
+    if start_date is None and end_date is None:
+        cached = db.execute(
+            select(CachedBalance.income_total, CachedBalance.expense_total)
+            .where(CachedBalance.user_id == user_id)
+        ).one_or_none()
+        income = float(cached.income_total) if cached else 0.0
+        expense = float(cached.expense_total) if cached else 0.0
+        return {
+            "income": income,
+            "expense": expense,
+            "balance": income - expense
+        }
+    
+    # Доходы и расходы одной строкой
+    stmt = select(
+        func.coalesce(func.sum(case((Transaction.type == TransactionType.INCOME, Transaction.amount))), 0).label('income'),
+        func.coalesce(func.sum(case((Transaction.type == TransactionType.EXPENSE, Transaction.amount))), 0).label('expense')
+    ).where(Transaction.user_id == user_id)
     
     if start_date:
-        query = query.filter(Transaction.date >= start_date)
+        stmt = stmt.where(Transaction.date >= start_date)
     if end_date:
-        query = query.filter(Transaction.date <= end_date)
+        stmt = stmt.where(Transaction.date <= end_date)
     
-    results = query.group_by(Transaction.type).all()
-    
-    income = sum(r.total for r in results if r.type == TransactionType.INCOME)
-    expense = sum(r.total for r in results if r.type == TransactionType.EXPENSE)
+    result = db.execute(stmt).one()
+    income = float(result.income)
+    expense = float(result.expense)
     
     return {
-        "income": float(income) if income else 0.0,
-        "expense": float(expense) if expense else 0.0,
-        "balance": float(income - expense) if income and expense else (float(income) if income else -float(expense) if expense else 0.0)
+        "income": income,
+        "expense": expense,
+        "balance": income - expense
     }
 
 
@@ -298,8 +599,7 @@ def create_budget(
         start_date=start_date
     )
     db.add(budget)
-    db.commit()
-    db.refresh(budget)
+    db.flush()
     return budget
 
 
@@ -313,13 +613,31 @@ def delete_budget(db: Session, budget_id: int) -> bool:
     budget = db.query(Budget).filter(Budget.id == budget_id).first()
     if budget:
         db.delete(budget)
-        db.commit()
+        db.flush()
         return True
     return False
 
 
 # ========== Statistics ==========
 
+def _full_months_range(start_date: Optional[date], end_date: Optional[date]) -> tuple[Optional[date], Optional[date]]:
+    """Первый и последний полные календарные месяцы внутри периода (первые числа месяцев).
+    
+    None на месте границы — период не ограничен с этой стороны.
+    """
+    first_month = start_date
+    if start_date is not None and start_date.day != 1:
+        first_month = (start_date.replace(day=1) + timedelta(days=32)).replace(day=1)
+    
+    last_month = end_date
+    if end_date is not None:
+        last_month = end_date.replace(day=1)
+        if (end_date + timedelta(days=1)).day != 1:
+            # Месяц end_date неполный — берём предыдущий
+            last_month = (last_month - timedelta(days=1)).replace(day=1)
+    return first_month, last_month
+
+
 def get_statistics_by_category(
     db: Session,
     user_id: int,
@@ -327,32 +645,70 @@ def get_statistics_by_category(
     start_date: Optional[date] = None,
     end_date: Optional[date] = None
 ) -> List[dict]:
-    """Получить статистику по категориям."""
-    query = db.query(
-        Category.name,
-        Category.icon,
-        func.sum(Transaction.amount).label('total'),
-        func.count(Transaction.id).label('count')
-    ).join(
-        Transaction, Transaction.category_id == Category.id
-    ).filter(
-        Transaction.user_id == user_id,
-        Transaction.type == transaction_type
-    )
+    """Получить статистику по категориям.
     
-    if start_date:
-        query = query.filter(Transaction.date >= start_date)
-    if end_date:
-        query = query.filter(Transaction.date <= end_date)
+    Полные календарные месяцы периода берутся из category_month_stats,
+    неполные месяцы на краях периода считаются по транзакциям.
+    """
+    first_month, last_month = _full_months_range(start_date, end_date)
     
-    results = query.group_by(Category.id, Category.name, Category.icon).order_by(func.sum(Transaction.amount).desc()).all()
+    def live_rows(range_start: Optional[date], range_end: Optional[date]):
+        stmt = select(
+            Transaction.category_id,
+            Transaction.amount.label('total'),
+            literal(1).label('count')
+        ).where(
+            Transaction.user_id == user_id,
+            Transaction.type == transaction_type
+        )
+        if range_start:
+            stmt = stmt.where(Transaction.date >= range_start)
+        if range_end:
+            stmt = stmt.where(Transaction.date <= range_end)
+        return stmt
+    
+    if first_month is not None and last_month is not None and first_month > last_month:
+        # Нет ни одного полного месяца
+        parts = [live_rows(start_date, end_date)]
+    else:
+        cached = select(
+            CategoryMonthStats.category_id,
+            CategoryMonthStats.total,
+            CategoryMonthStats.count
+        ).where(
+            CategoryMonthStats.user_id == user_id,
+            CategoryMonthStats.type == transaction_type
+        )
+        if first_month is not None:
+            cached = cached.where(CategoryMonthStats.month >= first_month)
+        if last_month is not None:
+            cached = cached.where(CategoryMonthStats.month <= last_month)
+        parts = [cached]
+        
+        if start_date is not None and start_date < first_month:
+            parts.append(live_rows(start_date, first_month - timedelta(days=1)))
+        if end_date is not None:
+            after_last_month = (last_month + timedelta(days=32)).replace(day=1)
+            if end_date >= after_last_month:
+                parts.append(live_rows(after_last_month, end_date))
+    
+    rows = union_all(*parts).subquery() if len(parts) > 1 else parts[0].subquery()
+    total = func.sum(rows.c.total)
+    count = func.sum(rows.c.count)
+    results = db.execute(
+        select(Category.name, Category.icon, total.label('total'), count.label('count'))
+        .join(rows, rows.c.category_id == Category.id)
+        .group_by(Category.id, Category.name, Category.icon)
+        .having(count > 0)
+        .order_by(total.desc())
+    ).all()
     
     return [
         {
             "name": r.name,
             "icon": r.icon,
             "total": float(r.total),
-            "count": r.count
+            "count": int(r.count)
         }
         for r in results
     ]
@@ -371,11 +727,17 @@ def get_average_daily_expense(
         start_date = date(end_date.year, end_date.month, 1)
     
     days = (end_date - start_date).days + 1
-    if days == 0:
+    if days <= 0:
         return 0.0
     
-    expenses = get_balance(db, user_id, start_date, end_date)["expense"]
-    return expenses / days if days > 0 else 0.0
+    expenses = db.execute(
+        select(func.coalesce(func.sum(Transaction.amount), 0)).where(
+            Transaction.user_id == user_id,
+            Transaction.type == TransactionType.EXPENSE,
+            Transaction.date.between(start_date, end_date)
+        )
+    ).scalar_one()
+    return float(expenses) / days
 
 
 # ========== MerchantRule CRUD ==========
@@ -408,8 +770,7 @@ def create_merchant_rule(
         existing_rule.category_id = category_id
         existing_rule.default_description = default_description
         existing_rule.updated_at = datetime.now()
-        db.commit()
-        db.refresh(existing_rule)
+        db.flush()
         return existing_rule
     
     # Создаём новое правило
@@ -420,8 +781,7 @@ def create_merchant_rule(
         default_description=default_description
     )
     db.add(rule)
-    db.commit()
-    db.refresh(rule)
+    db.flush()
     logger.info(f"Создано правило для мерчанта '{merchant_name}' пользователя {user_id}")
     return rule
 
@@ -431,12 +791,24 @@ def get_all_merchant_rules(db: Session, user_id: int) -> List[MerchantRule]:
     return db.query(MerchantRule).filter(MerchantRule.user_id == user_id).all()
 
 
+def get_merchant_rule_categories(db: Session, user_id: int) -> Dict[str, str]:
+    """Правила автокатегоризации пользователя: {мерчант: название категории} одним запросом."""
+    return {
+        row.merchant_name: row.name
+        for row in db.execute(
+            select(MerchantRule.merchant_name, Category.name)
+            .join(Category, Category.id == MerchantRule.category_id)
+            .where(MerchantRule.user_id == user_id)
+        )
+    }
+
+
 def delete_merchant_rule(db: Session, rule_id: int) -> bool:
     """Удалить правило автокатегоризации."""
     rule = db.query(MerchantRule).filter(MerchantRule.id == rule_id).first()
     if rule:
         db.delete(rule)
-        db.commit()
+        db.flush()
         return True
     return False
 
@@ -470,8 +842,7 @@ def create_receipt(
         raw_data=raw_data
     )
     db.add(receipt)
-    db.commit()
-    db.refresh(receipt)
+    db.flush()
     logger.info(f"Создан чек ID:{receipt.id} для пользователя {user_id}, сумма {total_amount}")
     return receipt
 
@@ -554,8 +925,7 @@ def attach_receipt_to_transaction(db: Session, receipt_id: int, transaction_id:
     receipt = get_receipt_by_id(db, receipt_id)
     if receipt:
         receipt.transaction_id = transaction_id
-        db.commit()
-        db.refresh(receipt)
+        db.flush()
         logger.info(f"Чек {receipt_id} прикреплён к транзакции {transaction_id}")
     return receipt
 
@@ -565,7 +935,7 @@ def delete_receipt(db: Session, receipt_id: int) -> bool:
     receipt = get_receipt_by_id(db, receipt_id)
     if receipt:
         db.delete(receipt)
-        db.commit()
+        db.flush()
         logger.info(f"Удалён чек {receipt_id}")
         return True
     return False
@@ -1,5 +1,7 @@
 """Модели базы данных."""
-from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Text, JSON, Boolean, Date, Enum as SQLEnum
+from sqlalchemy import Column, Integer, SmallInteger, BigInteger, String, Float, Numeric, DateTime, ForeignKey, Text, JSON, Boolean, Date, Index, Enum as SQLEnum
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from datetime import datetime
@@ -13,6 +15,27 @@ class TransactionType(str, enum.Enum):
     EXPENSE = "expense"
 
 
+# Коды типа транзакции в БД (столбец SMALLINT)
+TRANSACTION_TYPE_CODES = {TransactionType.INCOME: 0, TransactionType.EXPENSE: 1}
+TRANSACTION_TYPES_BY_CODE = {code: t for t, code in TRANSACTION_TYPE_CODES.items()}
+
+
+class TransactionTypeCode(TypeDecorator):
+    """TransactionType, хранящийся в БД как SMALLINT (0 — доход, 1 — расход)."""
+    impl = SmallInteger
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return TRANSACTION_TYPE_CODES[TransactionType(value)]
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return TRANSACTION_TYPES_BY_CODE[value]
+
+
 class BudgetPeriod(str, enum.Enum):
     """Период бюджета."""
     WEEKLY = "weekly"
@@ -27,7 +50,7 @@ class User(Base):
     telegram_id = Column(BigInteger, unique=True, index=True, nullable=False)
     username = Column(String(255), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    settings = Column(JSON, default={})
+    settings = Column(JSON().with_variant(JSONB(), "postgresql"), default={})
     
     # Связи
     transactions = relationship("Transaction", back_populates="user", cascade="all, delete-orphan")
@@ -42,7 +65,7 @@ class Category(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     name = Column(String(100), nullable=False)
-    type = Column(SQLEnum(TransactionType), nullable=False)
+    type = Column(TransactionTypeCode, nullable=False)
     icon = Column(String(10), default="📁")
     is_default = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -51,6 +74,11 @@ class Category(Base):
     user = relationship("User", back_populates="categories")
     transactions = relationship("Transaction", back_populates="category")
     budgets = relationship("Budget", back_populates="category")
+    
+    __table_args__ = (
+        # Категории пользователя по типу (доходы / расходы)
+        Index("ix_cat_user_type", "user_id", "type"),
+    )
 
 
 class Transaction(Base):
@@ -59,8 +87,8 @@ class Transaction(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    type = Column(SQLEnum(TransactionType), nullable=False)
-    amount = Column(Float, nullable=False)
+    type = Column(TransactionTypeCode, nullable=False)
+    amount = Column(Numeric(14, 2), nullable=False)
     category_id = Column(Integer, ForeignKey("categories.id"), nullable=True)
     date = Column(Date, nullable=False, default=func.current_date())
     description = Column(Text, nullable=True)
@@ -71,6 +99,37 @@ class Transaction(Base):
     user = relationship("User", back_populates="transactions")
     category = relationship("Category", back_populates="transactions")
     receipt = relationship("Receipt", back_populates="transaction", uselist=False)
+    
+    __table_args__ = (
+        # Поиск дубликатов при импорте выписок
+        Index("ix_tx_dedup", "user_id", "date", "amount"),
+        # Лента транзакций пользователя в порядке выдачи (без сортировки)
+        Index("ix_tx_user_date_created", user_id, date.desc(), created_at.desc()),
+        # Транзакции по категории; транзакции без категории в индекс не попадают
+        Index("ix_tx_user_cat", "user_id", "category_id", postgresql_where=category_id.isnot(None)),
+    )
+
+
+class CachedBalance(Base):
+    """Накопленные итоги доходов и расходов пользователя за всё время."""
+    __tablename__ = "cached_balances"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    income_total = Column(Numeric(16, 2), nullable=False, default=0)
+    expense_total = Column(Numeric(16, 2), nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class CategoryMonthStats(Base):
+    """Накопленные суммы транзакций по категории за календарный месяц."""
+    __tablename__ = "category_month_stats"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    category_id = Column(Integer, ForeignKey("categories.id"), primary_key=True)
+    type = Column(TransactionTypeCode, primary_key=True)
+    month = Column(Date, primary_key=True)  # Первое число месяца
+    total = Column(Numeric(16, 2), nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
 
 
 class Budget(Base):
@@ -80,7 +139,7 @@ class Budget(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     category_id = Column(Integer, ForeignKey("categories.id"), nullable=True)
-    limit_amount = Column(Float, nullable=False)
+    limit_amount = Column(Numeric(14, 2), nullable=False)
     period = Column(SQLEnum(BudgetPeriod), nullable=False)
     start_date = Column(Date, nullable=False, default=func.current_date())
     created_at = Column(DateTime(timezone=True), server_default=func.now())
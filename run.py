@@ -1,28 +1,28 @@
 """Точка входа для запуска бота."""
-import sys
-import subprocess
+from pathlib import Path
+from alembic import command
+from alembic.config import Config
 from bot.main import main
+from database.connection import engine
 from loguru import logger
 
+BASE_DIR = Path(__file__).resolve().parent
+
+
 def run_migrations():
     """Применить миграции базы данных."""
     try:
         logger.info("Applying database migrations...")
-        result = subprocess.run(
-            ["alembic", "upgrade", "head"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        # Alembic в том же процессе и на соединении из пула приложения
+        alembic_cfg = Config(str(BASE_DIR / "alembic.ini"))
+        alembic_cfg.set_main_option("script_location", str(BASE_DIR / "alembic"))
+        with engine.connect() as connection:
+            alembic_cfg.attributes["connection"] = connection
+            command.upgrade(alembic_cfg, "head")
         logger.info("Migrations applied successfully")
-        logger.debug(result.stdout)
         return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to apply migrations: {e}")
-        logger.error(f"Error output: {e.stderr}")
-        return False
     except Exception as e:
-        logger.error(f"Unexpected error during migrations: {e}")
+        logger.error(f"Failed to apply migrations: {e}")
         return False
 
 if __name__ == "__main__":
@@ -35,4 +35,3 @@ if __name__ == "__main__":
     
     # Запускаем бота
     main()
-
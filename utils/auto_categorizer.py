@@ -1,7 +1,206 @@
 """Автокатегоризация транзакций через Claude AI."""
-from typing import Dict, List, Optional, Any
+import copy
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Any, Tuple
+from cachetools import LRUCache
 from loguru import logger
-from ai.claude_client import ClaudeClient
+
+from ai.claude_client import get_claude_client
+from utils.helpers import find_category, strip_symbols
+
+# Поля ответа Claude с результатом категоризации
+_CATEGORY_RE = re.compile(r'Категория:\s*(.+?)(?:\n|$)', re.IGNORECASE)
+_DESCRIPTION_RE = re.compile(r'Описание:\s*(.+?)(?:\n|$)', re.IGNORECASE)
+_CONFIDENCE_RE = re.compile(r'Уверенность:\s*(high|medium|low)', re.IGNORECASE)
+
+# Популярные мерчанты: шаблон описания и категория расходов (без запроса к Claude)
+_MERCHANT_TEMPLATES = {
+    "перекрёсток": ("Покупка в Перекрёсток", "Продукты"),
+    "пятёрочка": ("Покупка в Пятёрочка", "Продукты"),
+    "магнит": ("Покупка в Магнит", "Продукты"),
+    "лента": ("Покупка в Лента", "Продукты"),
+    "ашан": ("Покупка в Ашан", "Продукты"),
+    "дикси": ("Покупка в Дикси", "Продукты"),
+    "вкусвилл": ("Покупка в ВкусВилл", "Продукты"),
+    "яндекс такси": ("Поездка на такси", "Транспорт"),
+    "такси": ("Поездка на такси", "Транспорт"),
+    "макдональдс": ("Еда в McDonald's", "Кафе"),
+    "kfc": ("Еда в KFC", "Кафе"),
+    "бургер кинг": ("Еда в Burger King", "Кафе"),
+    "subway": ("Еда в Subway", "Кафе"),
+    "додо пицца": ("Заказ пиццы", "Кафе"),
+    "аптека": ("Покупка в аптеке", "Здоровье"),
+    "аптечка": ("Покупка в аптеке", "Здоровье"),
+}
+_MERCHANT_TEMPLATE_LIST = list(_MERCHANT_TEMPLATES.items())
+# Ключ шаблона отдельным словом в названии мерчанта ("магнит", но не "магнитогорск")
+_MERCHANT_WORD_RES = [
+    (key, re.compile(rf'(?<!\w){re.escape(key)}(?!\w)'))
+    for key, _ in _MERCHANT_TEMPLATE_LIST
+]
+
+
+# Результаты категоризации Claude: (мерчант, описание, тип, категории) -> результат
+_categorization_cache: LRUCache = LRUCache(maxsize=4096)
+
+# Инструкции для категоризации (system prompt)
+_CATEGORIZER_SYSTEM_PROMPT = """Ты помощник для категоризации финансовых транзакций.
+
+Пользователь пришлёт мерчанта, описание и тип транзакции.
+
+Задача:
+1. Определи наиболее подходящую категорию из списка доступных категорий
+2. Предложи краткое и понятное описание транзакции (до 50 символов)
+3. Оцени уверенность в выборе категории (high/medium/low)
+
+Верни результат СТРОГО в формате:
+Категория: [название категории]
+Описание: [предложенное описание]
+Уверенность: [high/medium/low]
+
+Примеры:
+- Для "Перекрёсток" → Категория: Продукты, Описание: Покупка в Перекрёсток, Уверенность: high
+- Для "Яндекс Такси" → Категория: Транспорт, Описание: Поездка на такси, Уверенность: high
+- Для "Неизвестная покупка" → Категория: Прочее, Описание: Покупка, Уверенность: low"""
+
+
+def _default_categorization(merchant: str, transaction_type: str) -> Dict[str, Any]:
+    """Результат категоризации по умолчанию (нет категорий или ошибка Claude)."""
+    return {
+        "category_name": "Прочее",
+        "category_id": None,
+        "suggested_description": f"{'Покупка' if transaction_type == 'expense' else 'Поступление'} {merchant}",
+        "confidence": "low"
+    }
+
+
+def _categorization_cache_key(
+    merchant: str,
+    description: str,
+    transaction_type: str,
+    categories: List[Dict[str, Any]]
+) -> Tuple:
+    """Ключ кэша категоризации.
+    
+    Категории пользователя входят в ключ, поэтому после их изменения
+    результат запрашивается заново.
+    """
+    return (
+        merchant.strip().lower(),
+        (description or "").strip().lower(),
+        transaction_type,
+        tuple(sorted((cat.get("id") or 0, cat["name"]) for cat in categories)),
+    )
+
+
+def _template_categorization(
+    merchant: str,
+    transaction_type: str,
+    categories: List[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """Категоризация известного мерчанта по таблице шаблонов, без Claude.
+    
+    Возвращает None, если мерчанта нет в таблице или у пользователя нет
+    подходящей категории.
+    """
+    if transaction_type != "expense":
+        return None
+    # Без Claude — только точное совпадение или ключ отдельным словом
+    key = _find_merchant_template(merchant.lower().strip(), whole_word=True)
+    if key is None:
+        return None
+    template, category_name = _MERCHANT_TEMPLATES[key]
+    cat = find_category(categories, category_name)
+    if not cat:
+        return None
+    
+    logger.info(f"Быстрая категоризация '{merchant}' по шаблону: {cat['name']}")
+    return {
+        "category_name": cat["name"],
+        "category_id": cat.get("id"),
+        "suggested_description": template,
+        "confidence": "high"
+    }
+
+
+def _cached_categorization(key: Tuple) -> Optional[Dict[str, Any]]:
+    """Взять результат из кэша (копию, чтобы вызывающий код не менял кэш)."""
+    cached = _categorization_cache.get(key)
+    if cached is None:
+        logger.debug(f"Кэш категоризации: промах для '{key[0]}'")
+        return None
+    logger.debug(f"Кэш категоризации: попадание для '{key[0]}'")
+    return copy.deepcopy(cached)
+
+
+@lru_cache(maxsize=512)
+def _format_categories(categories_key: Tuple[Tuple[Optional[int], str, str], ...]) -> str:
+    """Список категорий для промпта; одинаковые категории дают байт-в-байт ту же строку."""
+    return "\n".join(f"- {icon} {name}" for _, icon, name in categories_key)
+
+
+def _categorization_system(categories: List[Dict[str, Any]]) -> str:
+    """System prompt категоризации: инструкции и список категорий."""
+    categories_str = _format_categories(
+        tuple((cat.get("id"), cat["icon"], cat["name"]) for cat in categories)
+    )
+    
+    return f"{_CATEGORIZER_SYSTEM_PROMPT}\n\nДоступные категории:\n{categories_str}"
+
+
+def _categorization_prompt(merchant: str, description: str, transaction_type: str) -> str:
+    """Пользовательская часть промпта категоризации одной транзакции."""
+    return f"""Мерчант: {merchant}
+Описание: {description}
+Тип транзакции: {"Расход" if transaction_type == "expense" else "Доход"}"""
+
+
+def _categorize_without_claude(
+    merchant: str,
+    description: str,
+    user_categories: List[Dict[str, Any]],
+    transaction_type: str
+) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], Tuple]:
+    """Подготовка к запросу категоризации.
+    
+    Возвращает (результат, категории нужного типа, ключ кэша); результат
+    не None, если запрос к Claude не нужен (нет категорий, шаблон или кэш).
+    """
+    # Фильтруем категории по типу транзакции
+    filtered_categories = [
+        cat for cat in user_categories 
+        if cat.get("type") == transaction_type
+    ]
+    
+    if not filtered_categories:
+        logger.warning(f"Нет категорий для типа {transaction_type}")
+        return _default_categorization(merchant, transaction_type), filtered_categories, ()
+    
+    # Известные мерчанты — по таблице шаблонов, без запроса к Claude
+    template_result = _template_categorization(merchant, transaction_type, filtered_categories)
+    if template_result is not None:
+        return template_result, filtered_categories, ()
+    
+    # Повторяющиеся транзакции — из кэша, без запроса к Claude
+    cache_key = _categorization_cache_key(merchant, description, transaction_type, filtered_categories)
+    return _cached_categorization(cache_key), filtered_categories, cache_key
+
+
+def _store_categorization(
+    merchant: str,
+    response: str,
+    filtered_categories: List[Dict[str, Any]],
+    cache_key: Tuple
+) -> Dict[str, Any]:
+    """Разобрать ответ Claude и сохранить результат в кэш."""
+    result = parse_categorization_response(response, filtered_categories)
+    
+    _categorization_cache[cache_key] = copy.deepcopy(result)
+    
+    logger.info(f"Автокатегоризация '{merchant}': {result['category_name']} ({result['confidence']})")
+    
+    return result
 
 
 def auto_categorize_transaction(
@@ -28,72 +227,54 @@ def auto_categorize_transaction(
         }
     """
     try:
-        # Фильтруем категории по типу транзакции
-        filtered_categories = [
-            cat for cat in user_categories 
-            if cat.get("type") == transaction_type
-        ]
+        result, filtered_categories, cache_key = _categorize_without_claude(
+            merchant, description, user_categories, transaction_type
+        )
+        if result is not None:
+            return result
         
-        if not filtered_categories:
-            logger.warning(f"Нет категорий для типа {transaction_type}")
-            return {
-                "category_name": "Прочее",
-                "category_id": None,
-                "suggested_description": f"{'Покупка' if transaction_type == 'expense' else 'Поступление'} {merchant}",
-                "confidence": "low"
-            }
+        # Запрос к Claude
+        claude = get_claude_client()
+        response = claude.get_completion(
+            _categorization_prompt(merchant, description, transaction_type),
+            system_prompt=_categorization_system(filtered_categories),
+            max_tokens=512
+        )
         
-        # Формируем список категорий для промпта
-        categories_str = "\n".join([
-            f"- {cat['icon']} {cat['name']}"
-            for cat in filtered_categories
-        ])
+        return _store_categorization(merchant, response, filtered_categories, cache_key)
         
-        # Промпт для Claude
-        prompt = f"""Ты помощник для категоризации финансовых транзакций.
-
-Мерчант: {merchant}
-Описание: {description}
-Тип транзакции: {"Расход" if transaction_type == "expense" else "Доход"}
-
-Доступные категории:
-{categories_str}
-
-Задача:
-1. Определи наиболее подходящую категорию из списка выше
-2. Предложи краткое и понятное описание транзакции (до 50 символов)
-3. Оцени уверенность в выборе категории (high/medium/low)
+    except Exception as e:
+        logger.error(f"Ошибка при автокатегоризации: {e}")
+        # Возвращаем дефолтные значения
+        return _default_categorization(merchant, transaction_type)
 
-Верни результат СТРОГО в формате:
-Категория: [название категории]
-Описание: [предложенное описание]
-Уверенность: [high/medium/low]
 
-Примеры:
-- Для "Перекрёсток" → Категория: Продукты, Описание: Покупка в Перекрёсток, Уверенность: high
-- Для "Яндекс Такси" → Категория: Транспорт, Описание: Поездка на такси, Уверенность: high
-- Для "Неизвестная покупка" → Категория: Прочее, Описание: Покупка, Уверенность: low"""
-
-        # Запрос к Claude
-        claude = ClaudeClient()
-        response = claude.get_completion(prompt, max_tokens=512)
-        
-        # Парсим ответ
-        result = parse_categorization_response(response, filtered_categories)
+async def auto_categorize_transaction_async(
+    merchant: str,
+    description: str,
+    user_categories: List[Dict[str, Any]],
+    transaction_type: str = "expense"
+) -> Dict[str, Any]:
+    """Асинхронный вариант auto_categorize_transaction (не блокирует event loop)."""
+    try:
+        result, filtered_categories, cache_key = _categorize_without_claude(
+            merchant, description, user_categories, transaction_type
+        )
+        if result is not None:
+            return result
         
-        logger.info(f"Автокатегоризация '{merchant}': {result['category_name']} ({result['confidence']})")
+        claude = get_claude_client()
+        response = await claude.aget_completion(
+            _categorization_prompt(merchant, description, transaction_type),
+            system_prompt=_categorization_system(filtered_categories),
+            max_tokens=512
+        )
         
-        return result
+        return _store_categorization(merchant, response, filtered_categories, cache_key)
         
     except Exception as e:
         logger.error(f"Ошибка при автокатегоризации: {e}")
-        # Возвращаем дефолтные значения
-        return {
-            "category_name": "Прочее",
-            "category_id": None,
-            "suggested_description": f"{'Покупка' if transaction_type == 'expense' else 'Поступление'} {merchant}",
-            "confidence": "low"
-        }
+        return _default_categorization(merchant, transaction_type)
 
 
 def parse_categorization_response(response: str, categories: List[Dict[str, Any]]) -> Dict[str, Any]:
@@ -105,8 +286,6 @@ def parse_categorization_response(response: str, categories: List[Dict[str, Any]
     Описание: Покупка в Перекрёсток
     Уверенность: high
     """
-    import re
-    
     result = {
         "category_name": "Прочее",
         "category_id": None,
@@ -116,28 +295,26 @@ def parse_categorization_response(response: str, categories: List[Dict[str, Any]
     
     try:
         # Извлекаем категорию
-        category_match = re.search(r'Категория:\s*(.+?)(?:\n|$)', response, re.IGNORECASE)
+        category_match = _CATEGORY_RE.search(response)
         if category_match:
             category_name = category_match.group(1).strip()
             # Убираем эмодзи если есть
-            category_name = re.sub(r'[^\w\s-]', '', category_name).strip()
+            category_name = strip_symbols(category_name).strip()
             result["category_name"] = category_name
             
             # Находим ID категории
-            for cat in categories:
-                cat_name_clean = re.sub(r'[^\w\s-]', '', cat['name']).strip()
-                if cat_name_clean.lower() == category_name.lower():
-                    result["category_id"] = cat['id']
-                    result["category_name"] = cat['name']  # Используем оригинальное название
-                    break
+            cat = find_category(categories, category_name)
+            if cat:
+                result["category_id"] = cat['id']
+                result["category_name"] = cat['name']  # Используем оригинальное название
         
         # Извлекаем описание
-        description_match = re.search(r'Описание:\s*(.+?)(?:\n|$)', response, re.IGNORECASE)
+        description_match = _DESCRIPTION_RE.search(response)
         if description_match:
             result["suggested_description"] = description_match.group(1).strip()
         
         # Извлекаем уверенность
-        confidence_match = re.search(r'Уверенность:\s*(high|medium|low)', response, re.IGNORECASE)
+        confidence_match = _CONFIDENCE_RE.search(response)
         if confidence_match:
             result["confidence"] = confidence_match.group(1).lower()
         
@@ -147,6 +324,29 @@ def parse_categorization_response(response: str, categories: List[Dict[str, Any]
     return result
 
 
+def _find_merchant_template(merchant_lower: str, whole_word: bool = False) -> Optional[str]:
+    """Ключ шаблона: точное совпадение или первый шаблон, содержащийся в названии мерчанта.
+    
+    С whole_word=True шаблон должен входить в название отдельным словом.
+    """
+    # Проверяем точное совпадение
+    if merchant_lower in _MERCHANT_TEMPLATES:
+        return merchant_lower
+    
+    if whole_word:
+        for key, word_re in _MERCHANT_WORD_RES:
+            if word_re.search(merchant_lower):
+                return key
+        return None
+    
+    # Проверяем частичное совпадение: шаблон содержится в названии мерчанта
+    for key, _ in _MERCHANT_TEMPLATE_LIST:
+        if key in merchant_lower:
+            return key
+    
+    return None
+
+
 def suggest_merchant_description(merchant: str, transaction_type: str = "expense") -> str:
     """
     Предложить описание для мерчанта без использования AI.
@@ -159,35 +359,16 @@ def suggest_merchant_description(merchant: str, transaction_type: str = "expense
     Returns:
         str: Предложенное описание
     """
-    # Словарь популярных мерчантов с шаблонами описаний
-    merchant_templates = {
-        "перекрёсток": "Покупка в Перекрёсток",
-        "пятёрочка": "Покупка в Пятёрочка",
-        "магнит": "Покупка в Магнит",
-        "лента": "Покупка в Лента",
-        "ашан": "Покупка в Ашан",
-        "дикси": "Покупка в Дикси",
-        "вкусвилл": "Покупка в ВкусВилл",
-        "яндекс такси": "Поездка на такси",
-        "такси": "Поездка на такси",
-        "макдональдс": "Еда в McDonald's",
-        "kfc": "Еда в KFC",
-        "бургер кинг": "Еда в Burger King",
-        "subway": "Еда в Subway",
-        "додо пицца": "Заказ пиццы",
-        "аптека": "Покупка в аптеке",
-        "аптечка": "Покупка в аптеке",
-    }
-    
     merchant_lower = merchant.lower().strip()
     
-    # Проверяем точное совпадение
-    if merchant_lower in merchant_templates:
-        return merchant_templates[merchant_lower]
+    # Подсказка описания: достаточно вхождения шаблона в название
+    key = _find_merchant_template(merchant_lower)
+    if key is not None:
+        return _MERCHANT_TEMPLATES[key][0]
     
-    # Проверяем частичное совпадение
-    for key, template in merchant_templates.items():
-        if key in merchant_lower or merchant_lower in key:
+    # Название мерчанта — часть шаблона
+    for key, (template, _) in _MERCHANT_TEMPLATE_LIST:
+        if merchant_lower in key:
             return template
     
     # Дефолтные шаблоны
@@ -195,4 +376,3 @@ def suggest_merchant_description(merchant: str, transaction_type: str = "expense
         return f"Покупка {merchant}"
     else:
         return f"Поступление {merchant}"
-
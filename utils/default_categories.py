@@ -24,19 +24,11 @@ DEFAULT_EXPENSE_CATEGORIES = [
 
 def create_default_categories(db, user_id: int):
     """Создать категории по умолчанию для пользователя."""
-    from database.crud import create_category
+    from database.crud import create_categories
     
-    categories = []
-    for cat_data in DEFAULT_INCOME_CATEGORIES + DEFAULT_EXPENSE_CATEGORIES:
-        category = create_category(
-            db=db,
-            user_id=user_id,
-            name=cat_data["name"],
-            transaction_type=cat_data["type"],
-            icon=cat_data["icon"],
-            is_default=True
-        )
-        categories.append(category)
-    
-    return categories
-
+    return create_categories(
+        db,
+        user_id,
+        DEFAULT_INCOME_CATEGORIES + DEFAULT_EXPENSE_CATEGORIES,
+        is_default=True
+    )
@@ -1,6 +1,23 @@
 """Вспомогательные функции."""
+import re
 from datetime import datetime, date
-from typing import Optional
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+# Символы валют по коду из настроек пользователя
+_CURRENCY_SYMBOLS = {
+    "RUB": "₽",
+    "USD": "$",
+    "EUR": "€",
+    "UAH": "₴",
+    "KZT": "₸"
+}
+
+# Всё, кроме цифр, точки и запятой (очистка введённой суммы)
+_AMOUNT_CLEAN_RE = re.compile(r'[^\d.,]')
+
+# Всё, кроме букв, цифр, пробелов и дефиса (эмодзи в названиях категорий)
+_CATEGORY_SYMBOLS_RE = re.compile(r'[^\w\s-]')
 
 
 def format_amount(amount: float, currency: str = None, user_settings: dict = None) -> str:
@@ -8,18 +25,19 @@ def format_amount(amount: float, currency: str = None, user_settings: dict = Non
     if currency is None:
         if user_settings and "currency" in user_settings:
             currency_code = user_settings["currency"]
-            currency_symbols = {
-                "RUB": "₽",
-                "USD": "$",
-                "EUR": "€",
-                "UAH": "₴",
-                "KZT": "₸"
-            }
-            currency = currency_symbols.get(currency_code, currency_code)
+            currency = _CURRENCY_SYMBOLS.get(currency_code, currency_code)
         else:
             currency = "₽"
     
-    return f"{amount:,.2f} {currency}".replace(",", " ")
+    return _format_cents(round(amount * 100), currency)
+
+
+@lru_cache(maxsize=1024)
+def _format_cents(cents: int, currency: str) -> str:
+    """Сумма в копейках -> "1 234.50 ₽" (разряды через пробел)."""
+    whole, fraction = divmod(abs(cents), 100)
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{whole:_}.{fraction:02d} {currency}".replace("_", " ")
 
 
 def format_date(d: date) -> str:
@@ -35,11 +53,35 @@ def format_datetime(dt: datetime) -> str:
 def parse_amount(text: str) -> Optional[float]:
     """Парсить сумму из текста."""
     try:
-        # Удаляем все символы кроме цифр, точки и запятой
-        cleaned = "".join(c for c in text if c.isdigit() or c in ".,")
-        # Заменяем запятую на точку
-        cleaned = cleaned.replace(",", ".")
+        # Удаляем все символы кроме цифр, точки и запятой; запятую заменяем на точку
+        cleaned = _AMOUNT_CLEAN_RE.sub("", text).replace(",", ".")
         return float(cleaned)
     except (ValueError, AttributeError):
         return None
 
+
+@lru_cache(maxsize=256)
+def _category_positions(names: Tuple[str, ...]) -> Dict[str, int]:
+    """Индекс {название без эмодзи в нижнем регистре: позиция в списке}."""
+    index = {}
+    for position, name in enumerate(names):
+        index.setdefault(strip_symbols(name).strip().lower(), position)
+    return index
+
+
+def strip_symbols(text: str) -> str:
+    """Убрать эмодзи и прочие символы, кроме букв, цифр, пробелов и дефиса."""
+    # Название из одного слова без эмодзи — частый случай, обходимся без regex
+    if text.isalnum():
+        return text
+    return _CATEGORY_SYMBOLS_RE.sub('', text)
+
+
+def find_category(categories: List[Dict[str, Any]], name: str) -> Optional[Dict[str, Any]]:
+    """Найти категорию по названию без учёта эмодзи и регистра.
+    
+    Индекс названий кэшируется по списку названий категорий, поэтому
+    повторные поиски по тем же категориям обходятся без регулярных выражений.
+    """
+    position = _category_positions(tuple(cat["name"] for cat in categories)).get(name.strip().lower())
+    return categories[position] if position is not None else None
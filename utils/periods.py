@@ -1,7 +1,13 @@
 """Утилиты для работы с расчётными периодами."""
 from datetime import date, timedelta
+from functools import lru_cache
 from typing import Tuple, Dict, Any
-from dateutil.relativedelta import relativedelta
+
+# Названия месяцев в родительном падеже; индекс — номер месяца
+_MONTH_NAMES = (
+    "", "января", "февраля", "марта", "апреля", "мая", "июня",
+    "июля", "августа", "сентября", "октября", "ноября", "декабря"
+)
 
 
 def get_period_boundaries(period_type: str, month_start: int = 1, reference_date: date = None) -> Tuple[date, date]:
@@ -19,6 +25,12 @@ def get_period_boundaries(period_type: str, month_start: int = 1, reference_date
     if reference_date is None:
         reference_date = date.today()
     
+    return _period_boundaries(period_type, month_start, reference_date)
+
+
+@lru_cache(maxsize=512)
+def _period_boundaries(period_type: str, month_start: int, reference_date: date) -> Tuple[date, date]:
+    """Границы периода для явной даты (кэшируются: сегодняшняя дата подставляется до кэша)."""
     if period_type == "today":
         return reference_date, reference_date
     
@@ -56,6 +68,7 @@ def get_period_boundaries(period_type: str, month_start: int = 1, reference_date
         return start_date, reference_date
 
 
+@lru_cache(maxsize=512)
 def get_period_start_date(reference_date: date, month_start: int) -> date:
     """
     Получить дату начала расчётного периода для заданной даты.
@@ -84,7 +97,8 @@ def get_period_start_date(reference_date: date, month_start: int) -> date:
         except ValueError:
             # Если day не существует в этом месяце (например, 31 февраля)
             # Берём последний день месяца
-            next_month = reference_date.replace(day=1) + relativedelta(months=1)
+            year, month = reference_date.year, reference_date.month
+            next_month = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
             last_day = (next_month - timedelta(days=1)).day
             return date(reference_date.year, reference_date.month, min(month_start, last_day))
     else:
@@ -116,17 +130,12 @@ def get_period_name(period_type: str, start_date: date, end_date: date) -> str:
     elif period_type == "week":
         return "Последние 7 дней"
     
-    elif period_type == "current":
-        if start_date.month == end_date.month:
-            return f"Текущий период ({start_date.day}-{end_date.day} {get_month_name(end_date.month)})"
-        else:
-            return f"Текущий период ({start_date.day} {get_month_name(start_date.month)} - {end_date.day} {get_month_name(end_date.month)})"
-    
-    elif period_type == "previous":
+    elif period_type in ("current", "previous"):
+        prefix = "Текущий период" if period_type == "current" else "Прошлый период"
+        end_month = _MONTH_NAMES[end_date.month]
         if start_date.month == end_date.month:
-            return f"Прошлый период ({start_date.day}-{end_date.day} {get_month_name(end_date.month)})"
-        else:
-            return f"Прошлый период ({start_date.day} {get_month_name(start_date.month)} - {end_date.day} {get_month_name(end_date.month)})"
+            return f"{prefix} ({start_date.day}-{end_date.day} {end_month})"
+        return f"{prefix} ({start_date.day} {_MONTH_NAMES[start_date.month]} - {end_date.day} {end_month})"
     
     elif period_type == "year":
         return f"Текущий год ({start_date.year})"
@@ -140,12 +149,7 @@ def get_period_name(period_type: str, start_date: date, end_date: date) -> str:
 
 def get_month_name(month: int) -> str:
     """Получить название месяца на русском."""
-    months = {
-        1: "января", 2: "февраля", 3: "марта", 4: "апреля",
-        5: "мая", 6: "июня", 7: "июля", 8: "августа",
-        9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
-    }
-    return months.get(month, "")
+    return _MONTH_NAMES[month] if 1 <= month <= 12 else ""
 
 
 def calculate_period_comparison(
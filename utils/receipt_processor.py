@@ -1,41 +1,42 @@
 """Обработка чеков через Claude Vision API."""
 import base64
-from typing import Dict, Any, Optional
+import io
+import re
+from typing import Awaitable, Callable, Dict, Any, Optional, Tuple
 from datetime import datetime
 from loguru import logger
-from ai.claude_client import ClaudeClient
 
+try:
+    from PIL import Image
+except ImportError:  # Без Pillow изображение отправляется как есть
+    Image = None
 
-def process_receipt_image(image_bytes: bytes, user_categories: list) -> Optional[Dict[str, Any]]:
-    """
-    Обработать изображение чека через Claude Vision API.
-    
-    Args:
-        image_bytes: Байты изображения чека
-        user_categories: Список категорий пользователя
-    
-    Returns:
-        dict: Структурированные данные чека или None при ошибке
-        {
-            "store_name": str,
-            "receipt_date": datetime,
-            "total_amount": float,
-            "vat_amount": float,
-            "receipt_number": str,
-            "items": [{"name": str, "price": float, "quantity": float, "total": float}],
-            "suggested_category": str,
-            "raw_data": dict
-        }
-    """
-    try:
-        # Конвертируем изображение в base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        
-        # Получаем список категорий для промпта
-        categories_str = ", ".join([cat["name"] for cat in user_categories])
-        
-        # Формируем промпт для Claude
-        prompt = f"""Проанализируй изображение чека и извлеки следующую информацию:
+from ai.claude_client import get_claude_client
+from utils.helpers import find_category, strip_symbols
+
+# Длинная сторона изображения чека для Claude Vision (больше — только лишние токены)
+RECEIPT_MAX_SIDE = 1568
+RECEIPT_JPEG_QUALITY = 85
+
+# Поля ответа Claude с данными чека
+# Все поля шапки находятся за один проход: (название поля, значение до конца строки)
+_FIELD_RE = re.compile(r'(Магазин|Дата|Сумма|НДС|Номер чека|Категория):[ \t]*([^\n]*)', re.IGNORECASE)
+_DATE_VALUE_RE = re.compile(r'\d{4}-\d{2}-\d{2}(?:\s+\d{2}:\d{2})?')
+_AMOUNT_VALUE_RE = re.compile(r'[\d\s,\.]+')
+# Нормализация суммы за один проход: "1 234,50" -> "1234.50"
+_AMOUNT_TRANS = str.maketrans({" ": "", ",": "."})
+
+# Начало списка товаров: всё, что до него, — шапка чека
+_ITEMS_MARKER = "Товары:"
+_ITEMS_SECTION_RE = re.compile(r'Товары:(.+?)(?:\n\n|$)', re.IGNORECASE | re.DOTALL)
+# Строка товара: "1. Молоко 3.2% 1л - 1 x 89 = 89"
+# [^\n]+ не захватывает следующую строку, (?=\n|\s*$) останавливается перед переносом
+_ITEM_RE = re.compile(r'(\d+)\.\s*([^\n]+?)\s+-\s+([\d\.]+)\s+x\s+([\d\s,\.]+)\s+=\s+([\d,\.]+)(?=\n|\s*$)')
+# Упрощённая строка товара: "1. Молоко - 89"
+_SIMPLE_ITEM_RE = re.compile(r'\d+\.\s*(.+?)\s*-\s*([\d\s,\.]+)')
+
+# Инструкции для распознавания чека (system prompt)
+_RECEIPT_SYSTEM_PROMPT = """Проанализируй изображение чека и извлеки следующую информацию:
 
 1. Название магазина/организации
 2. Дата и время покупки (в формате YYYY-MM-DD HH:MM)
@@ -44,8 +45,6 @@ def process_receipt_image(image_bytes: bytes, user_categories: list) -> Optional
 5. Номер чека/кассы (если есть)
 6. Список всех товаров/услуг с ценами
 
-Категоризируй покупку в одну из категорий: {categories_str}
-
 Верни результат СТРОГО в формате:
 
 Магазин: [название]
@@ -62,62 +61,135 @@ def process_receipt_image(image_bytes: bytes, user_categories: list) -> Optional
 
 Если какая-то информация не видна на чеке, укажи "нет" или пропусти."""
 
-        # Запрос к Claude
-        claude = ClaudeClient()
-        
-        try:
-            # Используем Vision API через messages.create
-            message = claude.client.messages.create(
-                model=claude.model,
-                max_tokens=2048,
-                messages=[
+
+def _preprocess_receipt(image_bytes: bytes) -> bytes:
+    """Уменьшить изображение чека и пережать в JPEG перед отправкой в Claude.
+    
+    Если Pillow не установлен или изображение не открылось, возвращает исходные байты.
+    """
+    if Image is None:
+        return image_bytes
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.thumbnail((RECEIPT_MAX_SIDE, RECEIPT_MAX_SIDE), Image.LANCZOS)
+            buffer = io.BytesIO()
+            img.convert("RGB").save(buffer, "JPEG", quality=RECEIPT_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning(f"Не удалось подготовить изображение чека: {e}")
+        return image_bytes
+    
+    processed = buffer.getvalue()
+    logger.debug(f"Изображение чека: {len(image_bytes)} -> {len(processed)} байт")
+    return processed
+
+
+def _receipt_request(image_bytes: bytes, user_categories: list, model: str) -> Tuple[str, Dict[str, Any]]:
+    """Подготовить base64 изображения и параметры запроса к Claude Vision API."""
+    # Уменьшаем изображение и конвертируем в base64
+    image_base64 = base64.b64encode(_preprocess_receipt(image_bytes)).decode('utf-8')
+    
+    # Инструкции и список категорий — в system prompt
+    categories_str = ", ".join([cat["name"] for cat in user_categories])
+    system_prompt = f"{_RECEIPT_SYSTEM_PROMPT}\n\nКатегоризируй покупку в одну из категорий: {categories_str}"
+    
+    params = {
+        "model": model,
+        "max_tokens": 2048,
+        "system": system_prompt,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
                     {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": image_base64
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": "image/jpeg",
+                            "data": image_base64
+                        }
+                    },
+                    {
+                        "type": "text",
+                        "text": "Извлеки данные из этого чека."
                     }
                 ]
-            )
-            
-            # Извлекаем текст из ответа
-            response_text = ""
-            if message.content and len(message.content) > 0:
-                first_content = message.content[0]
-                if hasattr(first_content, 'text'):
-                    response_text = first_content.text
-                elif isinstance(first_content, dict) and 'text' in first_content:
-                    response_text = first_content['text']
-                else:
-                    response_text = str(first_content)
-            
-            logger.info(f"Ответ Claude для чека (первые 500 символов): {response_text[:500]}")
-            
-            # Парсим ответ
-            parsed_data = parse_receipt_text(response_text, user_categories)
-            
-            if parsed_data:
-                # Сохраняем base64 изображения для БД
-                parsed_data["image_base64"] = image_base64
-                return parsed_data
-            else:
-                logger.warning("Не удалось распарсить ответ Claude для чека")
-                return None
-                
+            }
+        ]
+    }
+    return image_base64, params
+
+
+def _receipt_from_text(response_text: str, image_base64: str, user_categories: list) -> Optional[Dict[str, Any]]:
+    """Разобрать текст ответа Claude в данные чека."""
+    logger.info(f"Ответ Claude для чека (первые 500 символов): {response_text[:500]}")
+    
+    # Парсим ответ
+    parsed_data = parse_receipt_text(response_text, user_categories)
+    
+    if parsed_data:
+        # Сохраняем base64 изображения для БД
+        parsed_data["image_base64"] = image_base64
+        return parsed_data
+    else:
+        logger.warning("Не удалось распарсить ответ Claude для чека")
+        return None
+
+
+async def process_receipt_image_stream(
+    image_bytes: bytes,
+    user_categories: list,
+    on_header: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+) -> Optional[Dict[str, Any]]:
+    """Распознать чек через Claude Vision API, получая ответ потоком.
+    
+    Как только в ответе начинается раздел "Товары:", шапка чека (магазин,
+    дата, сумма) разбирается и передаётся в on_header, не дожидаясь списка
+    товаров.
+    
+    Returns:
+        dict: Структурированные данные чека или None при ошибке
+        {
+            "store_name": str,
+            "receipt_date": datetime,
+            "total_amount": float,
+            "vat_amount": float,
+            "receipt_number": str,
+            "items": [{"name": str, "price": float, "quantity": float, "total": float}],
+            "suggested_category": str,
+            "raw_data": dict
+        }
+    """
+    try:
+        claude = get_claude_client()
+        image_base64, params = _receipt_request(image_bytes, user_categories, claude.model)
+        
+        response_text = ""
+        header_sent = on_header is None
+        
+        try:
+            async with claude.aclient.messages.stream(**params) as stream:
+                async for text in stream.text_stream:
+                    response_text += text
+                    if header_sent:
+                        continue
+                    # Ищем маркер только в хвосте: начало ответа уже проверено
+                    marker_pos = response_text.find(
+                        _ITEMS_MARKER, max(0, len(response_text) - len(text) - len(_ITEMS_MARKER))
+                    )
+                    if marker_pos == -1:
+                        continue
+                    header_sent = True
+                    header = parse_receipt_text(response_text[:marker_pos], user_categories)
+                    if header:
+                        try:
+                            await on_header(header)
+                        except Exception as e:
+                            logger.warning(f"Не удалось показать шапку чека: {e}")
         except Exception as api_error:
             logger.error(f"Ошибка при запросе к Claude API: {api_error}")
             return None
+        
+        return _receipt_from_text(response_text, image_base64, user_categories)
             
     except Exception as e:
         logger.error(f"Ошибка при обработке чека: {e}")
@@ -135,8 +207,6 @@ def parse_receipt_text(text: str, user_categories: list) -> Optional[Dict[str, A
     Returns:
         dict: Распарсенные данные чека
     """
-    import re
-    
     result = {
         "store_name": None,
         "receipt_date": None,
@@ -149,15 +219,19 @@ def parse_receipt_text(text: str, user_categories: list) -> Optional[Dict[str, A
     }
     
     try:
+        # Поля шапки чека; если поле встречается несколько раз, берём первое
+        fields = {}
+        for field_match in _FIELD_RE.finditer(text):
+            fields.setdefault(field_match.group(1).lower(), field_match.group(2).strip())
+        
         # Извлекаем магазин
-        store_match = re.search(r'Магазин:\s*(.+?)(?:\n|$)', text, re.IGNORECASE)
-        if store_match:
-            result["store_name"] = store_match.group(1).strip()
+        if fields.get("магазин"):
+            result["store_name"] = fields["магазин"]
         
         # Извлекаем дату
-        date_match = re.search(r'Дата:\s*(\d{4}-\d{2}-\d{2}(?:\s+\d{2}:\d{2})?)', text, re.IGNORECASE)
+        date_match = _DATE_VALUE_RE.match(fields.get("дата", ""))
         if date_match:
-            date_str = date_match.group(1).strip()
+            date_str = date_match.group(0)
             try:
                 # Пробуем с временем
                 if ' ' in date_str:
@@ -171,62 +245,48 @@ def parse_receipt_text(text: str, user_categories: list) -> Optional[Dict[str, A
             result["receipt_date"] = datetime.now()
         
         # Извлекаем сумму
-        amount_match = re.search(r'Сумма:\s*([\d\s,\.]+)', text, re.IGNORECASE)
+        amount_match = _AMOUNT_VALUE_RE.match(fields.get("сумма", ""))
         if amount_match:
-            amount_str = amount_match.group(1).replace(" ", "").replace(",", ".")
+            amount_str = amount_match.group(0).translate(_AMOUNT_TRANS)
             try:
                 result["total_amount"] = float(amount_str)
             except ValueError:
                 logger.warning(f"Не удалось распарсить сумму: {amount_str}")
         
         # Извлекаем НДС
-        vat_match = re.search(r'НДС:\s*([\d\s,\.]+)', text, re.IGNORECASE)
+        vat_match = _AMOUNT_VALUE_RE.match(fields.get("ндс", ""))
         if vat_match:
-            vat_str = vat_match.group(1).replace(" ", "").replace(",", ".")
+            vat_str = vat_match.group(0).translate(_AMOUNT_TRANS)
             try:
                 result["vat_amount"] = float(vat_str)
             except ValueError:
                 pass
         
         # Извлекаем номер чека
-        number_match = re.search(r'Номер чека:\s*(.+?)(?:\n|$)', text, re.IGNORECASE)
-        if number_match:
-            number = number_match.group(1).strip()
-            if number.lower() not in ["нет", "не указан", "отсутствует"]:
-                result["receipt_number"] = number
+        number = fields.get("номер чека")
+        if number and number.lower() not in ["нет", "не указан", "отсутствует"]:
+            result["receipt_number"] = number
         
         # Извлекаем категорию
-        category_match = re.search(r'Категория:\s*(.+?)(?:\n|$)', text, re.IGNORECASE)
-        if category_match:
-            category_name = category_match.group(1).strip()
+        if fields.get("категория"):
             # Убираем эмодзи
-            category_name = re.sub(r'[^\w\s-]', '', category_name).strip()
+            category_name = strip_symbols(fields["категория"]).strip()
             
             # Проверяем, есть ли такая категория у пользователя
-            for cat in user_categories:
-                cat_name_clean = re.sub(r'[^\w\s-]', '', cat['name']).strip()
-                if cat_name_clean.lower() == category_name.lower():
-                    result["suggested_category"] = cat['name']
-                    break
-            else:
-                result["suggested_category"] = category_name
+            cat = find_category(user_categories, category_name)
+            result["suggested_category"] = cat['name'] if cat else category_name
         
         # Извлекаем товары
-        items_section = re.search(r'Товары:(.+?)(?:\n\n|$)', text, re.IGNORECASE | re.DOTALL)
+        items_section = _ITEMS_SECTION_RE.search(text)
         if items_section:
             items_text = items_section.group(1)
-            # Паттерн: "1. Молоко 3.2% 1л - 1 x 89 = 89"
-            # Используем [^\n]+ чтобы не захватывать следующую строку
-            # В конце используем (?=\n|\s*$) чтобы остановиться перед переносом строки
-            item_pattern = r'(\d+)\.\s*([^\n]+?)\s+-\s+([\d\.]+)\s+x\s+([\d\s,\.]+)\s+=\s+([\d,\.]+)(?=\n|\s*$)'
-            
-            for item_match in re.finditer(item_pattern, items_text):
+            for item_match in _ITEM_RE.finditer(items_text):
                 try:
                     item_num = item_match.group(1)
                     item_name = item_match.group(2).strip()
-                    quantity = float(item_match.group(3).replace(",", "."))
-                    price = float(item_match.group(4).replace(" ", "").replace(",", "."))
-                    total = float(item_match.group(5).replace(" ", "").replace(",", "."))
+                    quantity = float(item_match.group(3).translate(_AMOUNT_TRANS))
+                    price = float(item_match.group(4).translate(_AMOUNT_TRANS))
+                    total = float(item_match.group(5).translate(_AMOUNT_TRANS))
                     
                     result["items"].append({
                         "name": item_name,
@@ -240,11 +300,10 @@ def parse_receipt_text(text: str, user_categories: list) -> Optional[Dict[str, A
         
         # Если не извлечено ни одного товара, пробуем более простой паттерн
         if not result["items"]:
-            simple_pattern = r'\d+\.\s*(.+?)\s*-\s*([\d\s,\.]+)'
-            for item_match in re.finditer(simple_pattern, text):
+            for item_match in _SIMPLE_ITEM_RE.finditer(text):
                 try:
                     item_name = item_match.group(1).strip()
-                    price = float(item_match.group(2).replace(" ", "").replace(",", "."))
+                    price = float(item_match.group(2).translate(_AMOUNT_TRANS))
                     
                     result["items"].append({
                         "name": item_name,
@@ -1,13 +1,110 @@
 """Парсер выписок из различных форматов."""
+import asyncio
 import base64
+import csv
 import io
 import re
 import json
-from typing import List, Dict, Any, Optional
-from datetime import datetime
+from functools import lru_cache
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from datetime import date
 from loguru import logger
+import numpy as np
 import pandas as pd
-from ai.claude_client import ClaudeClient
+from ai.claude_client import get_claude_client
+from utils.helpers import find_category, strip_symbols
+from utils.text_parser import extract_merchant_from_description, normalize_merchant_name
+
+try:
+    import orjson
+except ImportError:  # Опциональная зависимость: без неё — стандартный json
+    orjson = None
+
+# Разбор JSON из ответов Claude (orjson в несколько раз быстрее json)
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+try:
+    import python_calamine
+except ImportError:  # Опциональная зависимость: без неё Excel читается через openpyxl
+    python_calamine = None
+
+# Движок чтения Excel (calamine на Rust в разы быстрее openpyxl)
+_EXCEL_ENGINE = 'calamine' if python_calamine is not None else 'openpyxl'
+
+# Символы, важные для поиска границ JSON-массива
+_JSON_TOKEN_RE = re.compile(r'[\[\]"\\]')
+# Markdown-выделение в ответе Claude (**жирный**, *курсив*)
+_MARKDOWN_RE = re.compile(r'\*\*|\*')
+# Блок транзакции в текстовом ответе Claude
+# (категория — остаток строки: [^\n]+ вместо ленивого .+? с просмотром вперёд на каждом символе)
+_TRANSACTION_BLOCK_RE = re.compile(
+    r'Доход/Расход:\s*(Доход|Расход)\s*\n\s*Сумма:\s*([\d\s,\.]+)\s*\n\s*Описание:\s*(.*?)\s*\n\s*Категория:\s*([^\n]+)',
+    re.DOTALL | re.IGNORECASE
+)
+# Начало блока транзакции (границы блоков ищутся одним проходом)
+_BLOCK_START_RE = re.compile(r'Доход/Расход:', re.IGNORECASE)
+# Даты в описании транзакции
+_DATE_PATTERNS = (
+    re.compile(r'(\d{2})\.(\d{2})\.(\d{4})'),  # ДД.ММ.ГГГГ
+    re.compile(r'(\d{4})-(\d{2})-(\d{2})'),    # ГГГГ-ММ-ДД
+)
+# Построчный разбор (альтернативный метод)
+_FIELD_LINE_RE = re.compile(r'(Доход/Расход|Сумма|Описание|Категория)\s*:\s*(.*)', re.IGNORECASE)
+_TYPE_WORD_RE = re.compile(r'(Доход|Расход)', re.IGNORECASE)
+_AMOUNT_DIGITS_RE = re.compile(r'([\d\s,\.]+)')
+
+# Даты в текстовом ответе Claude: ГГГГ-ММ-ДД, ГГГГ/ММ/ДД, ДД.ММ.ГГГГ, ДД/ММ/ГГГГ
+_TEXT_DATE_RE = re.compile(
+    r'(?:(\d{4})([-/])(\d{1,2})\2(\d{1,2})|(\d{1,2})([./])(\d{1,2})\6(\d{4}))'
+)
+# Форматы дат в CSV/Excel выписках (порядок важен: ДД/ММ раньше ММ/ДД)
+_TABLE_DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%d.%m.%Y",
+    "%d.%m.%Y %H:%M",
+    "%d.%m.%Y %H:%M:%S",
+    "%d/%m/%Y",
+    "%Y/%m/%d",
+    "%m/%d/%Y",
+)
+# Пробелы (в т.ч. неразрывные, \u00A0 и \u202F) и знаки валют в суммах выписки
+_TABLE_AMOUNT_CLEAN_RE = re.compile(r'[\s₽$€]')
+# Сколько значений столбца смотреть при определении формата даты
+DATE_FORMAT_SAMPLE_SIZE = 100
+
+
+def _known_category_name(user_categories: List[Dict], name: Optional[str]) -> str:
+    """Название категории пользователя для ответа Claude (без учёта эмодзи
+    и регистра); выдуманные Claude категории заменяются на "Прочее"."""
+    category = find_category(user_categories, strip_symbols(name)) if name else None
+    return category["name"] if category else "Прочее"
+
+
+def _fast_parse_date(value: str) -> Optional[date]:
+    """Разобрать дату из ответа Claude без strptime; None — не распознана."""
+    match = _TEXT_DATE_RE.fullmatch(value.strip())
+    if not match:
+        return None
+    try:
+        if match.group(1):
+            return date(int(match.group(1)), int(match.group(3)), int(match.group(4)))
+        return date(int(match.group(8)), int(match.group(7)), int(match.group(5)))
+    except ValueError:  # Несуществующая дата (например, 31.02)
+        return None
+
+
+def _transaction_block_matches(text: str, starts: List[int]) -> Iterator[re.Match]:
+    """Совпадения _TRANSACTION_BLOCK_RE по блокам "Доход/Расход: ...".
+    
+    Текст режется на блоки по меткам (starts — их позиции), и регулярное
+    выражение применяется к каждому блоку отдельно: ленивые .*? не
+    просматривают остаток ответа, и время разбора линейно по длине текста.
+    """
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        match = _TRANSACTION_BLOCK_RE.match(text, start, end)
+        if match:
+            yield match
 
 
 def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> List[Dict[str, Any]]:
@@ -25,14 +122,22 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
     transactions = []
     
     # Убираем markdown форматирование для упрощения парсинга
-    text_clean = re.sub(r'\*\*|\*', '', text)
+    text_clean = _MARKDOWN_RE.sub('', text)
     
     # Разбиваем текст на блоки транзакций
     # Ищем паттерн "Доход/Расход:" как начало транзакции
+    block_starts = [m.start() for m in _BLOCK_START_RE.finditer(text_clean)]
+    if not block_starts:
+        # Без меток тип транзакции не определить ни одним из методов разбора
+        logger.info("В тексте нет меток «Доход/Расход:», транзакции не найдены")
+        return transactions
+    
     # Используем более строгий паттерн для избежания ложных срабатываний
-    transaction_pattern = r'Доход/Расход:\s*(Доход|Расход)\s*\n\s*Сумма:\s*([\d\s,\.]+)\s*\n\s*Описание:\s*(.*?)\s*\n\s*Категория:\s*(.+?)(?=\n\s*Доход/Расход:|$)'
+    matches = _transaction_block_matches(text_clean, block_starts)
     
-    matches = re.finditer(transaction_pattern, text_clean, re.MULTILINE | re.DOTALL | re.IGNORECASE)
+    today = date.today()
+    # Даты из описаний, уже разобранные в этом ответе (None — некорректная дата)
+    description_dates: Dict[str, Optional[date]] = {}
     
     for match in matches:
         try:
@@ -68,33 +173,31 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
                 continue
             
             # Убираем эмодзи из категории если есть
-            category_clean = re.sub(r'[^\w\s-]', '', category).strip()
+            category_clean = strip_symbols(category).strip()
             
             # Пробуем найти дату в описании или используем текущую дату
-            date = datetime.now().date()
-            date_patterns = [
-                r'(\d{2})\.(\d{2})\.(\d{4})',  # ДД.ММ.ГГГГ
-                r'(\d{4})-(\d{2})-(\d{2})',    # ГГГГ-ММ-ДД
-            ]
-            
-            for pattern in date_patterns:
-                date_match = re.search(pattern, description)
+            trans_date = today
+            for pattern in _DATE_PATTERNS:
+                date_match = pattern.search(description)
                 if date_match:
-                    try:
-                        if '.' in date_match.group(0):
-                            # ДД.ММ.ГГГГ
-                            day, month, year = date_match.groups()
-                            date = datetime(int(year), int(month), int(day)).date()
-                        else:
-                            # ГГГГ-ММ-ДД
-                            year, month, day = date_match.groups()
-                            date = datetime(int(year), int(month), int(day)).date()
+                    date_str = date_match.group(0)
+                    if date_str not in description_dates:
+                        try:
+                            if '.' in date_str:
+                                # ДД.ММ.ГГГГ
+                                day, month, year = date_match.groups()
+                            else:
+                                # ГГГГ-ММ-ДД
+                                year, month, day = date_match.groups()
+                            description_dates[date_str] = date(int(year), int(month), int(day))
+                        except ValueError:
+                            description_dates[date_str] = None
+                    if description_dates[date_str] is not None:
+                        trans_date = description_dates[date_str]
                         break
-                    except ValueError:
-                        continue
             
             transactions.append({
-                "date": date,
+                "date": trans_date,
                 "amount": amount,
                 "type": transaction_type,
                 "description": description,
@@ -138,7 +241,7 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
                     
                     # Сохраняем транзакцию если есть все необходимые поля
                     transactions.append({
-                        "date": current_trans.get("date", datetime.now().date()),
+                        "date": current_trans.get("date", today),
                         "amount": current_trans["amount"],
                         "type": current_trans["type"],
                         "description": current_trans.get("description", ""),
@@ -148,8 +251,14 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
                     current_trans = {}
                 continue
             
-            # Ищем поля транзакции
-            if re.match(r'Доход/Расход:', line, re.IGNORECASE):
+            # Ищем поля транзакции: одно совпадение на строку, значение — после двоеточия
+            field_match = _FIELD_LINE_RE.match(line)
+            if not field_match:
+                continue
+            field = field_match.group(1).lower()
+            value = field_match.group(2).strip()
+            
+            if field == "доход/расход":
                 # Если уже есть транзакция с полями, сохраняем её перед началом новой
                 if current_trans and all(k in current_trans for k in ['type', 'amount']):
                     # ВАЖНО: Проверяем тип транзакции по описанию перед сохранением
@@ -170,7 +279,7 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
                     logger.debug(f"Сохраняю транзакцию: {current_trans['type']} - {current_trans['amount']} - {current_trans.get('description', '')[:50]}")
                     
                     transactions.append({
-                        "date": current_trans.get("date", datetime.now().date()),
+                        "date": current_trans.get("date", today),
                         "amount": current_trans["amount"],
                         "type": current_trans["type"],
                         "description": current_trans.get("description", ""),
@@ -180,7 +289,7 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
                 
                 # Начинаем новую транзакцию
                 current_trans = {}
-                trans_type = re.search(r'(Доход|Расход)', line, re.IGNORECASE)
+                trans_type = _TYPE_WORD_RE.search(value)
                 if trans_type:
                     trans_type_lower = trans_type.group(0).lower()
                     if "доход" in trans_type_lower:
@@ -191,8 +300,8 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
                     # Если не нашли явно, по умолчанию расход
                     current_trans["type"] = "expense"
             
-            elif re.match(r'Сумма:', line, re.IGNORECASE):
-                amount_match = re.search(r'([\d\s,\.]+)', line)
+            elif field == "сумма":
+                amount_match = _AMOUNT_DIGITS_RE.search(value)
                 if amount_match:
                     amount_str = amount_match.group(1).replace(" ", "").replace(",", ".")
                     try:
@@ -200,13 +309,11 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
                     except ValueError:
                         pass
             
-            elif re.match(r'Описание:', line, re.IGNORECASE):
-                desc = line.split(':', 1)[1].strip() if ':' in line else line
-                current_trans["description"] = desc
+            elif field == "описание":
+                current_trans["description"] = value
             
-            elif re.match(r'Категория:', line, re.IGNORECASE):
-                cat = line.split(':', 1)[1].strip() if ':' in line else line
-                current_trans["category"] = re.sub(r'[^\w\s-]', '', cat).strip()
+            else:  # Категория
+                current_trans["category"] = strip_symbols(value).strip()
         
         # Сохраняем последнюю транзакцию если есть
         if current_trans and all(k in current_trans for k in ['type', 'amount']):
@@ -228,7 +335,7 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
             logger.debug(f"Сохраняю последнюю транзакцию: {current_trans['type']} - {current_trans['amount']} - {current_trans.get('description', '')[:50]}")
             
             transactions.append({
-                "date": current_trans.get("date", datetime.now().date()),
+                "date": current_trans.get("date", today),
                 "amount": current_trans["amount"],
                 "type": current_trans["type"],
                 "description": current_trans.get("description", ""),
@@ -242,17 +349,19 @@ def parse_text_transactions(text: str, user_categories: List[Dict] = None) -> Li
     return transactions
 
 
-def parse_pdf_statement(pdf_bytes: bytes, user_categories: List[Dict]) -> List[Dict[str, Any]]:
-    """Парсить банковскую выписку из PDF через Claude API."""
-    try:
-        # Конвертируем PDF в base64
-        pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
-        
-        # Получаем список категорий для промпта
-        categories_str = ", ".join([f"{cat['icon']} {cat['name']}" for cat in user_categories])
-        
-        # Формируем промпт для Claude - просим текстовый список
-        prompt = f"""Проанализируй банковскую выписку в PDF и выпиши списком все транзакции с указанием:
+# Ограничение времени запроса распознавания PDF-выписки
+PDF_REQUEST_TIMEOUT = 300  # секунд
+# Beta-заголовок Files API (загрузка PDF вместо base64 в теле запроса)
+FILES_API_BETA = "files-api-2025-04-14"
+
+# Дополнение промпта для повторной попытки после ошибки API
+_PDF_RETRY_SUFFIX = """
+
+ВАЖНО: Верни ТОЛЬКО валидный JSON массив без дополнительного текста, комментариев или объяснений. Начни ответ сразу с символа '[' и закончи символом ']'."""
+
+
+# Промпт распознавания PDF-выписки; подставляется только список категорий
+_PDF_PROMPT_TEMPLATE = """Проанализируй банковскую выписку в PDF и выпиши списком все транзакции с указанием:
 
 Доход/Расход
 Сумма
@@ -284,152 +393,370 @@ def parse_pdf_statement(pdf_bytes: bytes, user_categories: List[Dict]) -> List[D
 
 Если категория не подходит ни к одной из списка, используй "Прочее".
 Выведи все транзакции из выписки по порядку."""
-        
-        claude = ClaudeClient()
-        
-        # Отправляем PDF в Claude через document API
-        # Согласно документации Claude API, для PDF используется формат document с base64
-        try:
-            request_params = {
-                "model": claude.model,
-                "max_tokens": 8192,  # Увеличено для больших выписок
-                "messages": [
+
+
+def _categories_key(user_categories: List[Dict]) -> Tuple[Tuple[str, str], ...]:
+    """Ключ кэша промптов: иконки и названия категорий по порядку."""
+    return tuple((cat["icon"], cat["name"]) for cat in user_categories)
+
+
+@lru_cache(maxsize=128)
+def _format_categories(categories_key: Tuple[Tuple[str, str], ...]) -> str:
+    """Список категорий для промпта: "☕ Кафе, 🛒 Продукты, ..."."""
+    return ", ".join(f"{icon} {name}" for icon, name in categories_key)
+
+
+@lru_cache(maxsize=128)
+def _build_pdf_prompt(categories_key: Tuple[Tuple[str, str], ...]) -> str:
+    """Промпт распознавания PDF-выписки для набора категорий."""
+    return _PDF_PROMPT_TEMPLATE.format(categories_str=_format_categories(categories_key))
+
+
+def _pdf_statement_prompt(user_categories: List[Dict]) -> str:
+    """Промпт распознавания PDF-выписки: текстовый список транзакций."""
+    # Категории пользователя меняются редко — промпт берём из кэша
+    return _build_pdf_prompt(_categories_key(user_categories))
+
+
+def _pdf_to_base64(pdf_bytes: bytes) -> str:
+    """PDF в base64-строку для запроса к Claude.
+    
+    Кодируем из memoryview, без копии входных байтов; промежуточный bytes
+    живёт только до декодирования. ASCII-декодирование даёт компактную
+    строку (1 байт на символ) без проверки UTF-8.
+    """
+    return base64.b64encode(memoryview(pdf_bytes)).decode('ascii')
+
+
+def _pdf_source(pdf_bytes: bytes, file_id: Optional[str]) -> Dict[str, Any]:
+    """Источник документа: загруженный файл (Files API) или base64."""
+    if file_id:
+        return {"type": "file", "file_id": file_id}
+    return {
+        "type": "base64",
+        "media_type": "application/pdf",
+        "data": _pdf_to_base64(pdf_bytes)
+    }
+
+
+def _pdf_request(source: Dict[str, Any], prompt: str, model: str) -> Dict[str, Any]:
+    """Параметры запроса к Claude: PDF как document и текст промпта."""
+    request_params = {
+        "model": model,
+        "max_tokens": 8192,  # Увеличено для больших выписок
+        "messages": [
+            {
+                "role": "user",
+                "content": [
                     {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "document",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "application/pdf",
-                                    "data": pdf_base64
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
+                        "type": "document",
+                        "source": source
+                    },
+                    {
+                        "type": "text",
+                        "text": prompt
                     }
                 ]
             }
-            
-            message = claude.client.messages.create(**request_params)
-        except Exception as api_error:
-            logger.error(f"Ошибка при запросе к Claude API: {api_error}")
-            # Пробуем альтернативный формат или другую модель
-            try:
-                # Пробуем использовать другую модель через fallback
-                logger.info("Пробую альтернативный метод...")
-                # Используем текстовый промпт с просьбой вернуть JSON
-                alternative_prompt = f"""{prompt}
+        ]
+    }
+    if source["type"] == "file":
+        request_params["betas"] = [FILES_API_BETA]
+    return request_params
 
-ВАЖНО: Верни ТОЛЬКО валидный JSON массив без дополнительного текста, комментариев или объяснений. Начни ответ сразу с символа '[' и закончи символом ']'."""
-                
-                request_params = {
-                    "model": claude.model,
-                    "max_tokens": 8192,  # Увеличено для больших выписок
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "document",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": "application/pdf",
-                                        "data": pdf_base64
-                                    }
-                                },
-                                {
-                                    "type": "text",
-                                    "text": alternative_prompt
-                                }
-                            ]
-                        }
-                    ]
-                }
-                
-                message = claude.client.messages.create(**request_params)
-            except Exception as retry_error:
-                logger.error(f"Ошибка при повторной попытке: {retry_error}")
-                raise ValueError(f"Не удалось обработать PDF через Claude API: {api_error}")
+
+def _use_retry_prompt(request_params: Dict[str, Any], prompt: str) -> None:
+    """Заменить текст промпта для повторной попытки; документ в запросе тот же."""
+    request_params["messages"][0]["content"][1]["text"] = prompt + _PDF_RETRY_SUFFIX
+
+
+def _normalize_amount(trans: Dict[str, Any]) -> float:
+    """Сумма транзакции числом; 0 — не распознана (транзакция будет пропущена)."""
+    try:
+        return float(trans.get("amount", 0))
+    except (TypeError, ValueError):
+        logger.warning(f"Ошибка при нормализации транзакции: некорректная сумма, данные: {trans}")
+        return 0.0
+
+
+def _normalize_transactions(transactions: List[Dict[str, Any]], user_categories: List[Dict]) -> List[Dict[str, Any]]:
+    """Привести транзакции из ответа Claude к формату импорта.
+    
+    Транзакции с нулевой, отрицательной или нераспознанной суммой
+    пропускаются; нераспознанная дата заменяется сегодняшней.
+    """
+    today = date.today()
+    amounts = [_normalize_amount(trans) for trans in transactions]
+    
+    # Категорий в выписке немного: каждое название сопоставляем один раз
+    category_names: Dict[Any, str] = {}
+    for trans in transactions:
+        name = trans.get("category_name")
+        if name not in category_names:
+            category_names[name] = _known_category_name(user_categories, name)
+    
+    def normalize_date(value: Any) -> date:
+        if isinstance(value, date):
+            return value
+        if isinstance(value, str):
+            return _fast_parse_date(value) or today
+        return today
+    
+    return [
+        {
+            "date": normalize_date(trans.get("date")),
+            "amount": amount,
+            "type": trans.get("type", "expense"),
+            "description": trans.get("description", ""),
+            "category_name": category_names[trans.get("category_name")]
+        }
+        for trans, amount in zip(transactions, amounts)
+        if amount > 0  # Пропускаем нулевые или отрицательные суммы
+    ]
+
+
+def _transactions_from_pdf_message(message, user_categories: List[Dict]) -> List[Dict[str, Any]]:
+    """Извлечь и нормализовать транзакции из ответа Claude на PDF-выписку."""
+    # Извлекаем транзакции из текстового ответа
+    if not message.content:
+        raise ValueError("Пустой ответ от Claude API")
+    response_text = get_claude_client().extract_text(message)
+    
+    logger.debug(f"Ответ Claude (первые 1000 символов): {response_text[:1000]}")
+    logger.info(f"Полный ответ Claude ({len(response_text)} символов): {response_text[:5000]}")  # Логируем до 5000 символов
+    
+    # Парсим текстовый формат транзакций
+    transactions = parse_text_transactions(response_text, user_categories)
+    logger.info(f"После парсинга извлечено {len(transactions)} транзакций")
+    
+    if not transactions:
+        raise ValueError(f"Не удалось извлечь транзакции из ответа Claude. Ответ (первые 500 символов): {response_text[:500]}")
+    
+    # Валидируем и нормализуем транзакции
+    normalized_transactions = _normalize_transactions(transactions, user_categories)
+    
+    if not normalized_transactions:
+        raise ValueError("Не удалось извлечь ни одной транзакции из ответа Claude")
+    
+    return normalized_transactions
+
+
+async def _upload_pdf(aclient, pdf_bytes: bytes) -> Optional[str]:
+    """Загрузить PDF через Files API; None — API недоступен (старый SDK или ошибка)."""
+    try:
+        uploaded = await asyncio.wait_for(
+            aclient.beta.files.upload(
+                file=("statement.pdf", pdf_bytes, "application/pdf"),
+                betas=[FILES_API_BETA]
+            ),
+            PDF_REQUEST_TIMEOUT
+        )
+    except Exception as e:
+        logger.warning(f"Files API недоступен, PDF будет отправлен в base64: {e}")
+        return None
+    return uploaded.id
+
+
+async def _delete_uploaded_pdf(aclient, file_id: str) -> None:
+    """Удалить загруженный PDF: выписку не храним у Anthropic дольше запроса."""
+    try:
+        await aclient.beta.files.delete(file_id, betas=[FILES_API_BETA])
+    except Exception as e:
+        logger.warning(f"Не удалось удалить загруженный PDF {file_id}: {e}")
+
+
+async def parse_pdf_statement_async(pdf_bytes: bytes, user_categories: List[Dict]) -> List[Dict[str, Any]]:
+    """Парсить банковскую выписку из PDF через Claude API.
+    
+    Не блокирует event loop: несколько выписок можно обрабатывать параллельно.
+    """
+    try:
+        prompt = _pdf_statement_prompt(user_categories)
         
-        # Извлекаем транзакции из текстового ответа
-        if message.content and len(message.content) > 0:
-            # Получаем текст из ответа
-            first_content = message.content[0]
-            if hasattr(first_content, 'text'):
-                response_text = first_content.text
-            elif isinstance(first_content, dict) and 'text' in first_content:
-                response_text = first_content['text']
-            else:
-                response_text = str(first_content)
-            
-            logger.debug(f"Ответ Claude (первые 1000 символов): {response_text[:1000]}")
-            logger.info(f"Полный ответ Claude ({len(response_text)} символов): {response_text[:5000]}")  # Логируем до 5000 символов
-            
-            # Парсим текстовый формат транзакций
-            transactions = parse_text_transactions(response_text, user_categories)
-            logger.info(f"После парсинга извлечено {len(transactions)} транзакций")
-            
-            if not transactions:
-                raise ValueError(f"Не удалось извлечь транзакции из ответа Claude. Ответ (первые 500 символов): {response_text[:500]}")
-            
-            # Валидируем и нормализуем транзакции
-            normalized_transactions = []
-            for trans in transactions:
+        claude = get_claude_client()
+        
+        # PDF загружается один раз и в запросе передаётся по file_id
+        file_id = await _upload_pdf(claude.aclient, pdf_bytes)
+        messages_api = claude.aclient.beta.messages if file_id else claude.aclient.messages
+        try:
+            # Отправляем PDF в Claude через document API
+            request_params = _pdf_request(_pdf_source(pdf_bytes, file_id), prompt, claude.model)
+            try:
+                message = await asyncio.wait_for(
+                    messages_api.create(**request_params), PDF_REQUEST_TIMEOUT
+                )
+            except Exception as api_error:
+                logger.error(f"Ошибка при запросе к Claude API: {api_error}")
                 try:
-                    # Парсим дату
-                    if isinstance(trans.get("date"), str):
-                        # Пробуем разные форматы даты
-                        date_formats = ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%Y/%m/%d"]
-                        parsed_date = None
-                        for fmt in date_formats:
-                            try:
-                                parsed_date = datetime.strptime(trans["date"], fmt).date()
-                                break
-                            except ValueError:
-                                continue
-                        if not parsed_date:
-                            parsed_date = datetime.now().date()
-                    else:
-                        parsed_date = datetime.now().date()
-                    
-                    amount = float(trans.get("amount", 0))
-                    if amount <= 0:
-                        continue  # Пропускаем нулевые или отрицательные суммы
-                    
-                    normalized_transactions.append({
-                        "date": parsed_date,
-                        "amount": amount,
-                        "type": trans.get("type", "expense"),
-                        "description": trans.get("description", ""),
-                        "category_name": trans.get("category", "Прочее")
-                    })
-                except Exception as e:
-                    logger.warning(f"Ошибка при нормализации транзакции: {e}, данные: {trans}")
-                    continue
-            
-            if not normalized_transactions:
-                raise ValueError("Не удалось извлечь ни одной транзакции из ответа Claude")
-            
-            return normalized_transactions
-        else:
-            raise ValueError("Пустой ответ от Claude API")
+                    logger.info("Пробую альтернативный метод...")
+                    _use_retry_prompt(request_params, prompt)
+                    message = await asyncio.wait_for(
+                        messages_api.create(**request_params), PDF_REQUEST_TIMEOUT
+                    )
+                except Exception as retry_error:
+                    logger.error(f"Ошибка при повторной попытке: {retry_error}")
+                    raise ValueError(f"Не удалось обработать PDF через Claude API: {api_error}")
+        finally:
+            if file_id:
+                await _delete_uploaded_pdf(claude.aclient, file_id)
+        
+        return _transactions_from_pdf_message(message, user_categories)
             
     except Exception as e:
         logger.error(f"Ошибка при парсинге PDF выписки: {e}")
         raise
 
 
+def _detect_datetime_format(series: pd.Series) -> Optional[str]:
+    """Определить формат дат столбца по первым значениям.
+    
+    Возвращает первый формат из _TABLE_DATE_FORMATS, которому соответствуют
+    больше 90% значений выборки, или None.
+    """
+    sample = series.dropna().astype(str).str.strip().head(DATE_FORMAT_SAMPLE_SIZE)
+    if sample.empty:
+        return None
+    for fmt in _TABLE_DATE_FORMATS:
+        if pd.to_datetime(sample, format=fmt, errors="coerce").notna().mean() > 0.9:
+            return fmt
+    return None
+
+
+def _parse_mixed_dates(values: pd.Series) -> pd.Series:
+    """Разобрать столбец дат в разных форматах.
+    
+    Каждый формат из _TABLE_DATE_FORMATS применяется векторно к ещё не
+    разобранным значениям; остаток разбирается с format="mixed" (день
+    первым). Одинаковые строки pandas разбирает один раз (cache=True).
+    """
+    parsed = pd.to_datetime(values, format=_TABLE_DATE_FORMATS[0], errors="coerce", cache=True)
+    for fmt in _TABLE_DATE_FORMATS[1:] + ("mixed",):
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed = parsed.fillna(pd.to_datetime(
+            values[missing], format=fmt, dayfirst=True, errors="coerce", cache=True
+        ))
+    return parsed
+
+
+def _frame_to_transactions(
+    df: pd.DataFrame,
+    date_col: Any,
+    amount_col: Any,
+    desc_col: Any
+) -> List[Dict[str, Any]]:
+    """Преобразовать таблицу выписки в транзакции (по столбцам, без цикла по строкам).
+    
+    Тип определяется по знаку суммы; строки с нулевой или нераспознанной
+    суммой пропускаются, нераспознанная дата заменяется сегодняшней.
+    """
+    if amount_col is None:
+        return []
+    
+    # Парсим даты: формат определяется один раз по выборке значений
+    dates = df[date_col]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        date_format = _detect_datetime_format(dates)
+        dates = dates.astype(str).str.strip()
+        if date_format:
+            dates = pd.to_datetime(dates, format=date_format, errors="coerce")
+        else:
+            dates = _parse_mixed_dates(dates)
+    dates = dates.fillna(pd.Timestamp(date.today())).dt.date
+    
+    # Парсим суммы
+    amounts = pd.to_numeric(
+        df[amount_col].astype(str)
+        .str.replace(_TABLE_AMOUNT_CLEAN_RE, "", regex=True)
+        .str.replace(",", ".", regex=False),
+        errors="coerce"
+    )
+    # Пропускаем нулевые и нераспознанные суммы
+    mask = amounts.notna() & (amounts != 0)
+    
+    frame = pd.DataFrame({
+        "date": dates,
+        "amount": amounts.abs().astype(float),
+        # Определяем тип по знаку суммы
+        "type": np.where(amounts >= 0, "income", "expense"),
+        "description": df[desc_col].fillna("").astype(str) if desc_col is not None else "",
+        "category_name": None  # Будет определена через Claude
+    })
+    
+    return frame[mask].to_dict("records")
+
+
+# Ключевые слова в заголовках колонок выписки -> роль колонки.
+# Заголовок, совпадающий с ключевым словом целиком, находится одним поиском
+# по словарю; иначе ключевые слова ищутся как подстроки (в порядке словаря)
+_COLUMN_KEYWORDS = {
+    "дата": "date",
+    "date": "date",
+    "день": "date",
+    "сумма": "amount",
+    "сум": "amount",
+    "amount": "amount",
+    "описание": "desc",
+    "опис": "desc",
+    "description": "desc",
+    "назначение": "desc",
+}
+
+
+def _detect_columns(columns) -> Tuple[Any, Any, Any]:
+    """Найти колонки даты, суммы и описания по заголовкам.
+    
+    Если колонка не найдена, берутся первые колонки по порядку.
+    """
+    found = {"date": None, "amount": None, "desc": None}
+    for col in columns:
+        col_lower = str(col).strip().casefold()
+        role = _COLUMN_KEYWORDS.get(col_lower)
+        if role is None:
+            role = next((r for word, r in _COLUMN_KEYWORDS.items() if word in col_lower), None)
+        if role is not None:
+            found[role] = col
+    
+    # Если не нашли автоматически, используем первые колонки
+    date_col = found["date"] if found["date"] is not None else columns[0]
+    amount_col = found["amount"]
+    if amount_col is None and len(columns) > 1:
+        amount_col = columns[1]
+    desc_col = found["desc"]
+    if desc_col is None and len(columns) > 2:
+        desc_col = columns[2]
+    return date_col, amount_col, desc_col
+
+
+# Допустимые разделители CSV (в порядке приоритета)
+_CSV_DELIMITERS = (",", ";", "\t")
+# Размер начала файла для определения разделителя
+CSV_SNIFF_BYTES = 8192
+
+
+def _sniff_delimiter(csv_bytes: bytes, encoding: str) -> str:
+    """Определить разделитель CSV по первым строкам файла."""
+    sample = csv_bytes[:CSV_SNIFF_BYTES].decode(encoding, errors="replace")
+    if len(csv_bytes) > CSV_SNIFF_BYTES:
+        # Обрезанную последнюю строку не учитываем
+        sample = sample[:sample.rfind("\n") + 1] or sample
+    try:
+        return csv.Sniffer().sniff(sample, delimiters="".join(_CSV_DELIMITERS)).delimiter
+    except csv.Error:
+        return _CSV_DELIMITERS[0]
+
+
 def parse_csv_statement(csv_bytes: bytes, encoding: str = "utf-8") -> List[Dict[str, Any]]:
     """Парсить банковскую выписку из CSV."""
     try:
-        # Пробуем разные разделители
-        for delimiter in [",", ";", "\t"]:
+        # Разделитель определяем по началу файла; остальные — запасные варианты
+        sniffed = _sniff_delimiter(csv_bytes, encoding)
+        delimiters = [sniffed] + [d for d in _CSV_DELIMITERS if d != sniffed]
+        for delimiter in delimiters:
             try:
-                df = pd.read_csv(io.BytesIO(csv_bytes), encoding=encoding, delimiter=delimiter)
+                # dtype=str: без вывода типов, даты и суммы разбираются отдельно
+                df = pd.read_csv(io.BytesIO(csv_bytes), encoding=encoding, delimiter=delimiter, dtype=str)
                 if len(df.columns) >= 2:  # Минимум 2 колонки (дата и сумма)
                     break
             except:
@@ -437,63 +764,9 @@ def parse_csv_statement(csv_bytes: bytes, encoding: str = "utf-8") -> List[Dict[
         else:
             raise ValueError("Не удалось определить формат CSV")
         
-        transactions = []
-        
-        # Пытаемся найти колонки автоматически
-        date_col = None
-        amount_col = None
-        desc_col = None
-        
-        for col in df.columns:
-            col_lower = str(col).lower()
-            if any(word in col_lower for word in ["дата", "date", "день"]):
-                date_col = col
-            elif any(word in col_lower for word in ["сумма", "amount", "сум"]):
-                amount_col = col
-            elif any(word in col_lower for word in ["описание", "description", "опис", "назначение"]):
-                desc_col = col
+        date_col, amount_col, desc_col = _detect_columns(df.columns)
         
-        # Если не нашли автоматически, используем первые колонки
-        if not date_col:
-            date_col = df.columns[0]
-        if not amount_col:
-            amount_col = df.columns[1] if len(df.columns) > 1 else None
-        if not desc_col and len(df.columns) > 2:
-            desc_col = df.columns[2]
-        
-        for _, row in df.iterrows():
-            try:
-                # Парсим дату
-                date_str = str(row[date_col])
-                try:
-                    parsed_date = pd.to_datetime(date_str).date()
-                except:
-                    parsed_date = datetime.now().date()
-                
-                # Парсим сумму
-                amount_str = str(row[amount_col]) if amount_col else "0"
-                amount = float(amount_str.replace(",", ".").replace(" ", ""))
-                
-                # Определяем тип по знаку суммы
-                transaction_type = "income" if amount >= 0 else "expense"
-                amount = abs(amount)
-                
-                # Описание
-                description = str(row[desc_col]) if desc_col else ""
-                
-                if amount > 0:  # Пропускаем нулевые суммы
-                    transactions.append({
-                        "date": parsed_date,
-                        "amount": amount,
-                        "type": transaction_type,
-                        "description": description,
-                        "category_name": None  # Будет определена через Claude
-                    })
-            except Exception as e:
-                logger.warning(f"Ошибка при парсинге строки CSV: {e}")
-                continue
-        
-        return transactions
+        return _frame_to_transactions(df, date_col, amount_col, desc_col)
         
     except Exception as e:
         logger.error(f"Ошибка при парсинге CSV выписки: {e}")
@@ -503,84 +776,70 @@ def parse_csv_statement(csv_bytes: bytes, encoding: str = "utf-8") -> List[Dict[
 def parse_excel_statement(excel_bytes: bytes) -> List[Dict[str, Any]]:
     """Парсить банковскую выписку из Excel."""
     try:
-        df = pd.read_excel(io.BytesIO(excel_bytes), engine='openpyxl')
-        
-        transactions = []
-        
-        # Аналогично CSV - находим колонки
-        date_col = None
-        amount_col = None
-        desc_col = None
+        try:
+            # dtype=str: без вывода типов, даты и суммы разбираются отдельно
+            df = pd.read_excel(io.BytesIO(excel_bytes), engine=_EXCEL_ENGINE, dtype=str)
+        except Exception as e:
+            if _EXCEL_ENGINE == 'openpyxl':
+                raise
+            # calamine понимает не все файлы — повторяем через openpyxl
+            logger.warning(f"Не удалось прочитать Excel через calamine: {e}")
+            df = pd.read_excel(io.BytesIO(excel_bytes), engine='openpyxl', dtype=str)
         
-        for col in df.columns:
-            col_lower = str(col).lower()
-            if any(word in col_lower for word in ["дата", "date", "день"]):
-                date_col = col
-            elif any(word in col_lower for word in ["сумма", "amount", "сум"]):
-                amount_col = col
-            elif any(word in col_lower for word in ["описание", "description", "опис", "назначение"]):
-                desc_col = col
+        date_col, amount_col, desc_col = _detect_columns(df.columns)
         
-        if not date_col:
-            date_col = df.columns[0]
-        if not amount_col:
-            amount_col = df.columns[1] if len(df.columns) > 1 else None
-        if not desc_col and len(df.columns) > 2:
-            desc_col = df.columns[2]
-        
-        for _, row in df.iterrows():
-            try:
-                date_str = str(row[date_col])
-                try:
-                    parsed_date = pd.to_datetime(date_str).date()
-                except:
-                    parsed_date = datetime.now().date()
-                
-                amount_str = str(row[amount_col]) if amount_col else "0"
-                amount = float(amount_str.replace(",", ".").replace(" ", ""))
-                
-                transaction_type = "income" if amount >= 0 else "expense"
-                amount = abs(amount)
-                
-                description = str(row[desc_col]) if desc_col else ""
-                
-                if amount > 0:
-                    transactions.append({
-                        "date": parsed_date,
-                        "amount": amount,
-                        "type": transaction_type,
-                        "description": description,
-                        "category_name": None
-                    })
-            except Exception as e:
-                logger.warning(f"Ошибка при парсинге строки Excel: {e}")
-                continue
-        
-        return transactions
+        return _frame_to_transactions(df, date_col, amount_col, desc_col)
         
     except Exception as e:
         logger.error(f"Ошибка при парсинге Excel выписки: {e}")
         raise
 
 
-def categorize_transactions_batch(
-    transactions: List[Dict[str, Any]],
-    user_categories: List[Dict]
-) -> List[Dict[str, Any]]:
-    """Категоризировать транзакции через Claude API (пакетная обработка)."""
-    if not transactions:
-        return []
+def _find_json_array(text: str) -> Optional[str]:
+    """Найти первый сбалансированный JSON-массив в тексте.
     
-    try:
-        categories_str = ", ".join([f"{cat['icon']} {cat['name']}" for cat in user_categories])
-        
-        # Формируем список транзакций для Claude
-        transactions_text = "\n".join([
-            f"- {trans['date']} | {trans['amount']:.2f} | {trans['type']} | {trans['description']}"
-            for trans in transactions[:50]  # Ограничиваем до 50 за раз
-        ])
-        
-        prompt = f"""Для каждой транзакции определи наиболее подходящую категорию из списка: {categories_str}
+    Один проход по тексту с учётом вложенных скобок и строковых литералов
+    (скобки внутри "..." и экранированные кавычки не считаются). Цикл идёт
+    только по скобкам, кавычкам и обратным слэшам — остальной текст
+    пропускает регулярное выражение.
+    """
+    start = text.find("[")
+    if start == -1:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped_pos = -1  # Позиция символа после "\" внутри строки
+    for token in _JSON_TOKEN_RE.finditer(text, start):
+        i = token.start()
+        char = token.group()
+        if in_string:
+            if i == escaped_pos:
+                continue
+            if char == "\\":
+                escaped_pos = i + 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
+# Транзакций выписки в одном запросе категоризации
+STATEMENT_CHUNK_SIZE = 50
+# Одновременных запросов категоризации выписки
+STATEMENT_CONCURRENCY = 4
+# Предельный размер ответа Claude с JSON категорий
+MAX_JSON_CHARS = 2_000_000
+
+# Промпт пакетной категоризации транзакций выписки
+_CATEGORIZE_PROMPT_TEMPLATE = """Для каждой транзакции определи наиболее подходящую категорию из списка: {categories_str}
 
 Транзакции:
 {transactions_text}
@@ -594,32 +853,110 @@ def categorize_transactions_batch(
 
 Если категория не подходит, используй "Прочее".
 Отвечай только JSON массивом."""
+
+
+def _categorize_chunk_prompt(chunk: List[Dict[str, Any]], categories_str: str) -> str:
+    """Промпт категоризации одной порции транзакций."""
+    # Формируем список транзакций для Claude
+    transactions_text = "\n".join([
+        f"- {trans['date']} | {trans['amount']:.2f} | {trans['type']} | {trans['description']}"
+        for trans in chunk
+    ])
+    return _CATEGORIZE_PROMPT_TEMPLATE.format(
+        categories_str=categories_str,
+        transactions_text=transactions_text
+    )
+
+
+def _apply_chunk_categories(chunk: List[Dict[str, Any]], response: str, user_categories: List[Dict]) -> None:
+    """Присвоить транзакциям порции категории из JSON-ответа Claude."""
+    # Слишком большой ответ не разбираем: категории порции — несколько КБ
+    if len(response) > MAX_JSON_CHARS:
+        raise ValueError(f"Слишком большой ответ Claude: {len(response)} символов")
+    
+    # Извлекаем JSON
+    json_str = _find_json_array(response)
+    
+    if json_str:
+        categories_list = _json_loads(json_str)
         
-        claude = ClaudeClient()
-        response = claude.get_completion(prompt, max_tokens=2048)
-        
-        # Извлекаем JSON
-        import json
-        json_start = response.find("[")
-        json_end = response.rfind("]") + 1
-        
-        if json_start != -1 and json_end > json_start:
-            categories_list = json.loads(response[json_start:json_end])
-            
-            # Присваиваем категории транзакциям
-            for i, trans in enumerate(transactions[:len(categories_list)]):
-                if i < len(categories_list):
-                    trans["category_name"] = categories_list[i].get("category", "Прочее")
-                else:
-                    trans["category_name"] = "Прочее"
-        
-        return transactions
-        
-    except Exception as e:
-        logger.error(f"Ошибка при категоризации транзакций: {e}")
-        # Если ошибка, используем "Прочее" для всех
-        for trans in transactions:
-            if not trans.get("category_name"):
-                trans["category_name"] = "Прочее"
+        # Категории идут в том же порядке, что и транзакции
+        for trans, item in zip(chunk, categories_list):
+            trans["category_name"] = _known_category_name(user_categories, item.get("category"))
+
+
+def _fill_default_category(chunk: List[Dict[str, Any]]) -> None:
+    """Проставить "Прочее" транзакциям без категории."""
+    for trans in chunk:
+        if not trans.get("category_name"):
+            trans["category_name"] = "Прочее"
+
+
+def _apply_merchant_rules(
+    transactions: List[Dict[str, Any]],
+    merchant_rules: Optional[Dict[str, str]]
+) -> List[Dict[str, Any]]:
+    """Проставить категории расходам по правилам мерчантов пользователя.
+    
+    Возвращает транзакции, для которых правила не нашлось (их категорию
+    определяет Claude).
+    """
+    if not merchant_rules:
         return transactions
+    
+    pending = []
+    for trans in transactions:
+        category_name = None
+        if trans.get("type") == "expense":
+            merchant = extract_merchant_from_description(trans.get("description") or "")
+            if merchant:
+                category_name = merchant_rules.get(normalize_merchant_name(merchant))
+        if category_name:
+            trans["category_name"] = category_name
+        else:
+            pending.append(trans)
+    
+    if len(pending) < len(transactions):
+        logger.info(f"По правилам мерчантов категоризировано {len(transactions) - len(pending)} транзакций")
+    return pending
+
+
+async def categorize_transactions_batch_async(
+    transactions: List[Dict[str, Any]],
+    user_categories: List[Dict],
+    merchant_rules: Optional[Dict[str, str]] = None,
+    concurrency: int = STATEMENT_CONCURRENCY
+) -> List[Dict[str, Any]]:
+    """Категоризировать транзакции через Claude API порциями по STATEMENT_CHUNK_SIZE.
+    
+    Порции отправляются в Claude параллельно (не больше concurrency
+    одновременно). merchant_rules — правила мерчантов пользователя
+    {мерчант: категория}; совпавшие с ними расходы в Claude не отправляются.
+    """
+    if not transactions:
+        return []
+    
+    pending = _apply_merchant_rules(transactions, merchant_rules)
+    categories_str = _format_categories(_categories_key(user_categories))
+    claude = get_claude_client()
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def _categorize_chunk(chunk: List[Dict[str, Any]]) -> None:
+        try:
+            async with semaphore:
+                response = await claude.aget_completion(
+                    _categorize_chunk_prompt(chunk, categories_str), max_tokens=2048
+                )
+            _apply_chunk_categories(chunk, response, user_categories)
+        except Exception as e:
+            logger.error(f"Ошибка при категоризации транзакций: {e}")
+            _fill_default_category(chunk)
+    
+    # Категории проставляются в сами словари, порядок транзакций не меняется
+    await asyncio.gather(*[
+        _categorize_chunk(pending[start:start + STATEMENT_CHUNK_SIZE])
+        for start in range(0, len(pending), STATEMENT_CHUNK_SIZE)
+    ])
+    
+    return transactions
 
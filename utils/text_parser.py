@@ -3,6 +3,27 @@ import re
 from typing import Optional, Dict, Any
 from loguru import logger
 
+# Формат: [знак] [сумма][знак] [описание/мерчант]:
+# "− 379 Перекрёсток", "-379 Перекрёсток", "+1500 зарплата", "1500+ зарплата",
+# "379 Перекрёсток" (без знака, по умолчанию расход)
+_TRANSACTION_TEXT_RE = re.compile(
+    r'^(?P<lsign>[−\-+])?\s*(?P<amount>[0-9]+(?:[.,][0-9]{1,2})?)(?P<rsign>\+)?\s+(?P<merchant>.+)$',
+    re.UNICODE
+)
+# Знаки препинания и пробелы в конце названия мерчанта
+_TRAILING_PUNCT_RE = re.compile(r'[!?,.\s]+$')
+# Паттерны для извлечения мерчанта из описания. Проверяются по очереди
+# (порядок — приоритет), а не одной альтернацией: единый поиск вернул бы самое
+# левое совпадение любой ветки, и для части строк выписки мерчант бы изменился,
+# перестав совпадать с правилами мерчантов при импорте выписки
+_MERCHANT_PATTERNS = (
+    re.compile(r'(?:в|В)\s+([А-ЯЁа-яё\w\s]+)'),  # "в Перекрёсток"
+    re.compile(r'(?:QR|qr)\s+([А-ЯЁа-яё\w\s]+)'),  # "QR Пятёрочка"
+    re.compile(r'(?:Списание|списание).*?([А-ЯЁа-яё\w]+)$'),  # "Списание ... Магнит"
+)
+# Цифры, знаки валют и разделители в последнем слове описания
+_CURRENCY_STRIP_RE = re.compile(r'[0-9₽$€£.,-]')
+
 
 def parse_transaction_text(text: str) -> Optional[Dict[str, Any]]:
     """
@@ -29,59 +50,47 @@ def parse_transaction_text(text: str) -> Optional[Dict[str, Any]]:
     
     text = text.strip()
     
-    # Паттерны для распознавания
-    # Формат: [знак] [сумма] [описание/мерчант]
-    patterns = [
-        # "− 379 Перекрёсток" или "-379 Перекрёсток" или "+1500 зарплата"
-        r'^([−\-+])\s*([0-9]+(?:[.,][0-9]{1,2})?)\s+(.+)$',
-        # "379 Перекрёсток" (без знака, по умолчанию расход)
-        r'^([0-9]+(?:[.,][0-9]{1,2})?)\s+(.+)$',
-    ]
+    # Быстрый путь для частых "379 Перекрёсток" и "+1500 зарплата": целая сумма
+    # сразу со знаком или без — разбираем без регулярного выражения
+    parts = text.split(None, 1)
+    if len(parts) == 2 and "\n" not in parts[1]:
+        token = parts[0]
+        sign = token[0] if token[0] in "+-−" else ""
+        digits = token[len(sign):]
+        if digits.isascii() and digits.isdigit() and int(digits) > 0:
+            return {
+                "amount": float(digits),
+                "type": "income" if sign == "+" else "expense",
+                "merchant": parts[1],
+                "raw_text": text
+            }
     
-    for pattern in patterns:
-        match = re.match(pattern, text, re.UNICODE)
-        if match:
-            groups = match.groups()
-            
-            # Определяем тип, сумму и описание в зависимости от паттерна
-            if len(groups) == 3:
-                # Паттерн с явным знаком: "− 379 Перекрёсток"
-                sign = groups[0]
-                amount_str = groups[1]
-                merchant = groups[2].strip()
-                
-                # Определяем тип транзакции
-                transaction_type = "income" if sign == "+" else "expense"
-            elif len(groups) == 2:
-                # Паттерн без знака: "379 Перекрёсток"
-                amount_str = groups[0]
-                merchant = groups[1].strip()
-                transaction_type = "expense"  # По умолчанию расход
-            else:
-                continue
-            
-            # Парсим сумму
-            try:
-                amount = float(amount_str.replace(',', '.').replace(' ', ''))
-            except ValueError:
-                logger.warning(f"Не удалось распарсить сумму: {amount_str}")
-                continue
-            
-            # Валидация
-            if amount <= 0:
-                logger.warning(f"Сумма должна быть положительной: {amount}")
-                continue
-            
-            if not merchant:
-                logger.warning(f"Не указан мерчант или описание")
-                continue
-            
+    match = _TRANSACTION_TEXT_RE.match(text)
+    if match:
+        amount_str = match.group("amount")
+        merchant = match.group("merchant").strip()
+        
+        # Определяем тип транзакции: знак слева от суммы главнее; "+" справа
+        # ("1500+ зарплата") учитывается, только если слева знака нет
+        sign = match.group("lsign") or match.group("rsign")
+        transaction_type = "income" if sign == "+" else "expense"
+        
+        # Парсим сумму (формат суммы гарантирован паттерном)
+        amount = float(amount_str.replace(',', '.'))
+        
+        # Валидация
+        if amount <= 0:
+            logger.warning(f"Сумма должна быть положительной: {amount}")
+        elif not merchant:
+            logger.warning(f"Не указан мерчант или описание")
+        else:
             return {
                 "amount": amount,
                 "type": transaction_type,
                 "merchant": merchant,
                 "raw_text": text
             }
+        return None
     
     logger.debug(f"Не удалось распарсить текст транзакции: {text}")
     return None
@@ -103,7 +112,7 @@ def normalize_merchant_name(merchant: str) -> str:
     normalized = merchant.strip().lower()
     
     # Убираем знаки препинания в конце
-    normalized = re.sub(r'[!?,.\s]+$', '', normalized)
+    normalized = _TRAILING_PUNCT_RE.sub('', normalized)
     
     return normalized
 
@@ -120,15 +129,8 @@ def extract_merchant_from_description(description: str) -> Optional[str]:
     if not description:
         return None
     
-    # Паттерны для извлечения мерчанта
-    patterns = [
-        r'(?:в|В)\s+([А-ЯЁа-яё\w\s]+)',  # "в Перекрёсток"
-        r'(?:QR|qr)\s+([А-ЯЁа-яё\w\s]+)',  # "QR Пятёрочка"
-        r'(?:Списание|списание).*?([А-ЯЁа-яё\w]+)$',  # "Списание ... Магнит"
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, description)
+    for pattern in _MERCHANT_PATTERNS:
+        match = pattern.search(description)
         if match:
             merchant = match.group(1).strip()
             if len(merchant) >= 3:  # Минимальная длина названия
@@ -139,7 +141,7 @@ def extract_merchant_from_description(description: str) -> Optional[str]:
     if words:
         last_word = words[-1].strip()
         # Убираем числа и спец символы
-        last_word = re.sub(r'[0-9₽$€£.,-]', '', last_word)
+        last_word = _CURRENCY_STRIP_RE.sub('', last_word)
         if len(last_word) >= 3:
             return last_word
     